@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# Offline benchmark of the rmads pipeline with stub whisper and gpt4all models
+#
+#   python bench/bench_rmads.py -m 30 -S native -o bench.json
+#
+# Runs each tests/ fixture and a synthetic long audio built from them and
+# reports split, transcribe, classify, render and stats time per segment and
+# per minute of audio.
+
+import argparse
+import contextlib
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'src'))
+import rmads  # noqa: E402
+
+FIXTURES = ['withads.mp3', 'withads.ogg', 'allads.mp3',
+            'noads.mp3', 'road_not_taken.mp3']
+STAGES = ['split', 'transcribe', 'classify', 'render', 'stats']
+AD_TEXT = 'This episode is brought to you by our sponsor. Use code rmads for 20 percent off.'
+CONTENT_TEXT = 'Two roads diverged in a yellow wood, and sorry I could not travel both.'
+
+
+class StubWhisper:
+
+    def transcribe(self, source, **kwargs):
+        # Every third segment is an ad
+        size = os.path.getsize(source) if isinstance(
+            source, str) else len(source)
+        return {'text': AD_TEXT if size % 3 == 0 else CONTENT_TEXT, 'segments': []}
+
+
+class StubGPT4All:
+
+    @contextlib.contextmanager
+    def chat_session(self, system_prompt=None):
+        yield
+
+    def generate(self, prompt, max_tokens=None):
+        if '\n1: ' not in prompt:
+            return 'YES' if 'sponsor' in prompt else 'NO'
+        texts = prompt.split('\n\n')[1:]
+        return '\n'.join('%d: %s' % (i, 'YES' if 'sponsor' in text else 'NO')
+                         for i, text in enumerate(texts, start=1))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='offline benchmark of the rmads pipeline')
+    parser.add_argument('-b', '--batch', type=int, default=1, metavar='SEGMENTS',
+                        help='number of split segments to classify per llm request')
+    parser.add_argument('-m', '--minutes', type=float, default=10,
+                        help='length of the synthetic long audio (0 skips it)')
+    parser.add_argument('-o', '--output', default=None, metavar='FILE',
+                        help='also write the results as json')
+    parser.add_argument('-S', '--splitter', default='native', choices=['mp3splt', 'native'],
+                        help='splitter to benchmark')
+    return parser.parse_args()
+
+
+def make_long_audio(path, minutes):
+    # Fixtures are decoded, repeated up to the length and encoded once
+    audio = np.concatenate([rmads.load_audio(ROOT / 'tests' / fixture)
+                            for fixture in FIXTURES])
+    repeats = int(np.ceil(minutes * 60 * rmads.SAMPLE_RATE / len(audio)))
+    audio = np.tile(audio, repeats)[:int(minutes * 60 * rmads.SAMPLE_RATE)]
+    subprocess.run(shlex.split(rmads.get_encode_command(path)), check=True,
+                   input=np.clip(audio * 32768, -32768, 32767).astype(np.int16).tobytes())
+
+
+def run(options, audiofile, workdir):
+    for subdir in (rmads.SPLITDIR, rmads.WHISPDIR, rmads.LLMDIR):
+        Path(workdir, subdir).mkdir(parents=True, exist_ok=True)
+
+    sys.argv = ['rmads.py', str(audiofile), '-d', str(workdir),
+                '-S', options.splitter, '-b', str(options.batch)]
+    args = rmads.get_args()
+    rmads.MODELS[('whisper', args.whisper)] = StubWhisper()
+    rmads.MODELS[('gpt4all', args.gpt4all)] = StubGPT4All()
+    rmads.STAGE_TIMES.clear()
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        rmads.process_audiofile(args, str(audiofile), args.gpt4all)
+    total = time.perf_counter() - start
+
+    # Audio without silence has no segments and no stats file
+    statspath = Path(workdir, '%s_stats.json' % Path(audiofile).stem)
+    segments = 0
+    if statspath.is_file():
+        segments = len(json.loads(statspath.read_text())['segments'])
+    result = {'audiofile': Path(audiofile).name, 'minutes': rmads.get_duration(str(audiofile)) / 60,
+              'segments': segments, 'total': total}
+    for stage in STAGES:
+        result[stage] = rmads.STAGE_TIMES.get(stage, {}).get('seconds', 0.0)
+    return result
+
+
+def format_result(result):
+    line = '%-20s %7.2f min %5d segments %8.2f s' % (
+        result['audiofile'], result['minutes'], result['segments'], result['total'])
+    for stage in STAGES:
+        line += '  %s=%.3fs (%.1f ms/seg, %.3f s/min)' % (
+            stage, result[stage], result[stage] * 1000 / max(result['segments'], 1),
+            result[stage] / result['minutes'])
+    return line
+
+
+def main():
+    options = get_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        audiofiles = [ROOT / 'tests' / fixture for fixture in FIXTURES]
+        if options.minutes > 0:
+            longaudio = Path(tmpdir, 'long_%gmin.mp3' % options.minutes)
+            make_long_audio(longaudio, options.minutes)
+            audiofiles.append(longaudio)
+
+        for audiofile in audiofiles:
+            result = run(options, audiofile, Path(
+                tmpdir, 'work', audiofile.stem))
+            print(format_result(result))
+            results.append(result)
+
+    if options.output:
+        Path(options.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
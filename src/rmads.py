@@ -8,27 +8,38 @@
 #   defined as GEMINI_API_KEY="YOUR_API_KEY" in an .env file
 
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import datetime
 import glob
-import google.generativeai as genai
+import hashlib
+import http.server
+import importlib
+import io
+import itertools
 import json
+import math
+import multiprocessing
+import numpy as np
 import os
+import queue
 import re
 import shlex
 import shutil
-import sox
+import sqlite3
 import subprocess
 import sys
 import tempfile
+import threading
 import time
-import whisper
+import urllib.request
 from dotenv import load_dotenv
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
-from gpt4all import GPT4All
 from pathlib import Path
 
 
-def get_args():
+def get_args(argv=None):
     global SPLITCHG
     SPLITCHG = 'Change -e, -m or -s to adjust number of split files. '
     WHISPCHG = 'Change -w to adjust audio to text recognition. '
@@ -38,27 +49,59 @@ def get_args():
                                      description='rmads is a CLI for removing ads from audio files to quantify ad statistics',
                                      epilog=SPLITCHG + WHISPCHG + LLMCHG)
     parser.add_argument('audiofiles', metavar='audiofile',
-                        nargs='+', help='audio file to remove ads from')
+                        nargs='*', help='audio file to remove ads from')
     # https://docs.gpt4all.io/gpt4all_python/home.html#load-llm
     parser.add_argument('-a', '--gpt4all', default='Meta-Llama-3-8B-Instruct.Q4_0.gguf', choices=['Meta-Llama-3-8B-Instruct.Q4_0.gguf', 'Nous-Hermes-2-Mistral-7B-DPO.Q4_0.gguf', 'Phi-3-mini-4k-instruct.Q4_0.gguf', 'orca-mini-3b-gguf2-q4_0.gguf', 'gpt4all-13b-snoozy-q4_0.gguf'],
                         help='gpt4all model to use for ad recognition')
+    parser.add_argument('-A', '--ads-file', action='store_true',
+                        help='also write the ads to an _ads audio file')
+    parser.add_argument('-b', '--batch', type=int, default=1, metavar='SEGMENTS',
+                        help='number of split segments (> 0) to classify per llm request')
+    parser.add_argument('--cache', default=None, metavar='DIRECTORY',
+                        help='shared cache of text and responses keyed by audio and text content')
+    parser.add_argument('--cache-size', type=int, default=1024, metavar='MB',
+                        help='maximum size of the shared cache before least recently used entries are removed')
+    parser.add_argument('--cascade', type=float, default=None, metavar='CONFIDENCE',
+                        help='probability (0.5 to 1.0) at which the --train pre-classifier decides a segment without the llm')
     parser.add_argument('-c', '--count',
-                        action='store_true', help='count the number of split files created and then exit')
+                        action='store_true', help='count the number of split files created and then exit (without writing files with -S native)')
+    parser.add_argument('--cue', action='store_true',
+                        help='write a cue file marking ad and content segments (with -S native or -G)')
     parser.add_argument('-d', '--dir', default='.', metavar='DIRECTORY',
                         help='working directory')
     parser.add_argument('-e', '--th', type=int, default=-48, metavar='THRESHOLD',
                         help='dB threshold level (-96 to 0) for silence when splitting audio')
     # https://ai.google.dev/gemini-api/docs/models/gemini#model-variations
+    parser.add_argument('-f', '--follow', type=float, default=None, metavar='SECONDS',
+                        help='follow a growing audio file (or - for stdin) and remove ads as segments close, stopping after SECONDS without new data (0 waits forever)')
+    parser.add_argument('--fingerprint', action='store_true',
+                        help='label segments matching the audio of earlier ads as ads without whisper or the llm and index new ads')
     parser.add_argument('-g', '--gemini', choices=['gemini-pro', 'gemini-1.5-pro', 'gemini-1.5-flash', 'gemini-1.5-flash-8b', 'gemini-2.0-flash'],
                         help='gemini model to use for ad recognition')
+    parser.add_argument('-E', '--episode', action='store_true',
+                        help='transcribe the whole audio once and slice the text per split segment (implies -S native)')
     parser.add_argument('-G', '--gemini-audio', choices=['gemini-1.5-pro', 'gemini-1.5-flash', 'gemini-1.5-flash-8b', 'gemini-2.0-flash'],
                         help='gemini model to use for audio upload ad recognition')
+    parser.add_argument('--gemini-window', type=float, default=600, metavar='SECONDS',
+                        help='length of the overlapping windows -G audio is split into and queried in parallel (0 sends the whole audio)')
+    parser.add_argument('--index', action='store_true',
+                        help='add the audio of ads in llm responses in the working directory to the --fingerprint index and then exit')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of audio files (> 0) to process in parallel')
     parser.add_argument('-k', '--keyword-file', default=None, metavar='keywords.txt',
-                        help='line separated keyword file to use to id an ad')
+                        help='line separated keyword file (keyword or keyword,weight with numbers like 1,000 kept in the keyword) to use to id an ad')
+    parser.add_argument('--keyword-score', type=float, default=1.0, metavar='SCORE',
+                        help='sum of matched keyword weights needed to id an ad without the llm')
     parser.add_argument('-l', '--lang', default='en', metavar='LANGUAGE',
                         help='language to use for audio to text')
     parser.add_argument('-m', '--min', type=float, default=1.0, metavar='SECONDS',
                         help='minimum seconds (> 0.0) to be considered valid silence when splitting audio')
+    parser.add_argument('--metrics', default=None, metavar='FILE',
+                        help='write stage times and counters in prometheus text format at the end of the run')
+    parser.add_argument('--migrate', action='store_true',
+                        help='copy existing whisper and llm progress files into the --store file and then exit')
+    parser.add_argument('--nonspeech', default=None, choices=['content', 'ad', 'neighbour'],
+                        help='skip transcription of music and other non-speech segments and label them as content, as ads or like the neighbouring speech')
     parser.add_argument('-p', '--purge', action='store_true',
                         help='purge all progress files of file arg')
     parser.add_argument('-P', '--purge-all', action='store_true',
@@ -67,17 +110,220 @@ def get_args():
                         help='split segment to retry (01, 02, ...)')
     parser.add_argument('--rpm', type=int, default=None,
                         help='override requests per minute when making API calls')
+    parser.add_argument('--serve', type=int, default=None, metavar='PORT',
+                        help='keep models loaded and process jobs posted to a local http api on PORT')
     parser.add_argument('-s', '--shots', type=int, default=25,
                         help='shots (> 0) of non silence when splitting audio')
+    parser.add_argument('--tpm', type=int, default=None,
+                        help='override tokens per minute when making API calls')
+    parser.add_argument('-S', '--splitter', default='mp3splt', choices=['mp3splt', 'native'],
+                        help='split audio with mp3splt files or natively in memory')
+    parser.add_argument('--store', action='store_true',
+                        help='keep progress in a single sqlite file instead of whisper and llm files')
+    parser.add_argument('--submit', type=int, default=None, metavar='PORT',
+                        help='send the audio files and options to the --serve api on PORT and wait for the result')
+    parser.add_argument('--sweep', action='store_true',
+                        help='count the number of native split segments for a grid of -e, -m and -s values and then exit')
+    parser.add_argument('--trace', default=None, metavar='FILE',
+                        help='write spans of each stage and segment in chrome trace event format (chrome://tracing, ui.perfetto.dev)')
+    parser.add_argument('--train', action='store_true',
+                        help='train the --cascade pre-classifier from llm responses in the working directory and then exit')
     parser.add_argument('-t', '--toggle', nargs='*', metavar='SEGMENT',
                         help='split segment to toggle ad (01, 02, ...)')
     # https://github.com/openai/whisper?tab=readme-ov-file#available-models-and-languages
     parser.add_argument('-w', '--whisper', default='base.en', choices=['tiny', 'tiny.en', 'base', 'base.en', 'small',
                         'small.en', 'medium', 'medium.en', 'large'], help='whisper model to use for text recognition')
+    parser.add_argument('--whisper-batch', type=int, default=1, metavar='SEGMENTS',
+                        help='number of split segments (> 0) up to 30 seconds long to transcribe in one whisper batch')
     parser.add_argument('-v', '--verbose', default=None,
                         action='store_true', help='verbose output')
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if not args.audiofiles and not args.train and not args.index and not args.migrate and args.serve is None:
+        parser.error('the following arguments are required: audiofile')
+
+    return args
+
+
+SEP = '=========='
+SPLITDIR = 'mp3splt'
+WHISPDIR = 'whisper'
+LLMDIR = 'llm'
+PROFILEDIR = 'profile'
+EPISODEDIR = 'episode'
+STOREDB = 'rmads.db'
+CASCADEFILE = 'cascade.json'
+CASCADE_CONFIDENCE = 0.9
+
+# Models stay resident for the rest of the run once loaded
+MODELS = {}
+MODEL_STATS = {}
+
+
+def load_model(backend, name):
+    # Backends are imported on first use so commands that never touch them
+    # start instantly
+    if backend == 'whisper':
+        import whisper
+        return whisper.load_model(name)
+    from gpt4all import GPT4All
+    return GPT4All(name)
+
+
+def get_model(args, backend, name):
+    key = (backend, name)
+    stats = MODEL_STATS.setdefault(key, {'loads': 0, 'hits': 0, 'seconds': 0.0})
+    if key in MODELS:
+        stats['hits'] += 1
+        return MODELS[key]
+
+    start = time.time()
+    with timed('load', backend=backend, model=name):
+        MODELS[key] = load_model(backend, name)
+    stats['loads'] += 1
+    stats['seconds'] += time.time() - start
+    if args.verbose:
+        print('Loaded %s model "%s" in %.1f seconds' %
+              (backend, name, stats['seconds']))
+
+    return MODELS[key]
+
+
+def copy_model_stats():
+    return {key: dict(stat) for key, stat in MODEL_STATS.items()}
+
+
+def merge_model_stats(stats):
+    # Worker processes of --jobs load and hit their own resident models
+    for key, stat in stats.items():
+        total = MODEL_STATS.setdefault(
+            key, {'loads': 0, 'hits': 0, 'seconds': 0.0})
+        total['loads'] += stat['loads']
+        total['hits'] += stat['hits']
+        total['seconds'] += stat['seconds']
+
+
+def get_model_stats():
+    stats = ''
+    for (backend, name), stat in MODEL_STATS.items():
+        stats += '%s model "%s" loads=%d hits=%d load time=%.1f seconds\n' % (
+            backend, name, stat['loads'], stat['hits'], stat['seconds'])
+    return stats
+
+
+# Wall time and calls per pipeline stage. Transcription runs in its own
+# thread so stage times can add up to more than the total.
+STAGE_TIMES = {}
+
+# Spans of each stage call in Chrome trace event format (None unless
+# --trace) and counters of cache hits, short-circuits, tokens and throttling
+TRACE_EVENTS = None
+TRACE_START = time.perf_counter()
+COUNTERS = collections.Counter()
+TRACE_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def timed(stage, **details):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        # The transcription thread and the main thread time stages at once
+        with TRACE_LOCK:
+            stats = STAGE_TIMES.setdefault(
+                stage, {'calls': 0, 'seconds': 0.0})
+            stats['calls'] += 1
+            stats['seconds'] += end - start
+            if TRACE_EVENTS is not None:
+                TRACE_EVENTS.append({'name': stage, 'cat': 'rmads', 'ph': 'X',
+                                     'ts': (start - TRACE_START) * 1000000, 'dur': (end - start) * 1000000,
+                                     'pid': os.getpid(), 'tid': threading.get_ident(), 'args': details})
+
+
+def count_metric(counter, value=1):
+    with TRACE_LOCK:
+        COUNTERS[counter] += value
+
+
+def get_stage_stats():
+    stats = ''
+    for stage, stat in STAGE_TIMES.items():
+        stats += 'Stage %s calls=%d time=%.2f seconds\n' % (
+            stage, stat['calls'], stat['seconds'])
+    return stats
+
+
+def get_telemetry():
+    with TRACE_LOCK:
+        return {'events': list(TRACE_EVENTS or []), 'counters': dict(COUNTERS),
+                'stages': {stage: dict(stat) for stage, stat in STAGE_TIMES.items()}}
+
+
+def reset_telemetry():
+    with TRACE_LOCK:
+        if TRACE_EVENTS is not None:
+            TRACE_EVENTS.clear()
+        COUNTERS.clear()
+        STAGE_TIMES.clear()
+
+
+def merge_telemetry(telemetry):
+    # Worker processes of --jobs send theirs back with each result
+    with TRACE_LOCK:
+        if TRACE_EVENTS is not None:
+            TRACE_EVENTS.extend(telemetry['events'])
+        COUNTERS.update(telemetry['counters'])
+        for stage, stat in telemetry['stages'].items():
+            stats = STAGE_TIMES.setdefault(
+                stage, {'calls': 0, 'seconds': 0.0})
+            stats['calls'] += stat['calls']
+            stats['seconds'] += stat['seconds']
+
+
+def get_telemetry_since(before):
+    # What was recorded after an earlier get_telemetry()
+    after = get_telemetry()
+    stages = {}
+    for stage, stat in after['stages'].items():
+        earlier = before['stages'].get(stage, {'calls': 0, 'seconds': 0.0})
+        if stat['calls'] > earlier['calls']:
+            stages[stage] = {'calls': stat['calls'] - earlier['calls'],
+                             'seconds': stat['seconds'] - earlier['seconds']}
+    return {'events': after['events'][len(before['events']):],
+            'counters': {counter: value - before['counters'].get(counter, 0)
+                         for counter, value in after['counters'].items()
+                         if value != before['counters'].get(counter, 0)},
+            'stages': stages}
+
+
+def write_trace(path, telemetry=None):
+    telemetry = telemetry or get_telemetry()
+    # Final counter values are a counter event at the end of the trace
+    events = telemetry['events'] + [{'name': 'counters', 'ph': 'C', 'ts': (time.perf_counter() - TRACE_START) * 1000000,
+                                     'pid': os.getpid(), 'args': telemetry['counters']}]
+    Path(path).write_text(json.dumps(
+        {'traceEvents': events, 'displayTimeUnit': 'ms'}))
+
+
+def get_metrics(telemetry=None):
+    # Prometheus text exposition format
+    telemetry = telemetry or get_telemetry()
+    metrics = '# HELP rmads_stage_seconds_total Wall seconds spent in each pipeline stage.\n'
+    metrics += '# TYPE rmads_stage_seconds_total counter\n'
+    for stage, stat in telemetry['stages'].items():
+        metrics += 'rmads_stage_seconds_total{stage="%s"} %g\n' % (
+            stage, stat['seconds'])
+    metrics += '# HELP rmads_stage_calls_total Calls of each pipeline stage.\n'
+    metrics += '# TYPE rmads_stage_calls_total counter\n'
+    for stage, stat in telemetry['stages'].items():
+        metrics += 'rmads_stage_calls_total{stage="%s"} %d\n' % (
+            stage, stat['calls'])
+    for counter, value in sorted(telemetry['counters'].items()):
+        metrics += '# TYPE rmads_%s_total counter\n' % counter
+        metrics += 'rmads_%s_total %g\n' % (counter, value)
+    return metrics
 
 
 def get_split_command(args, dir, filepath):
@@ -93,18 +339,354 @@ def get_concat_command(concatpath, filepath):
         concatpath, filepath)
 
 
-def get_ads_stats(audiofile, adcount, noadsfile=None):
+# Audio is decoded the same way whisper does (mono 16 kHz float32)
+SAMPLE_RATE = 16000
+# Silence is measured in mp3 frame sized shots (1152 samples at 44.1 kHz)
+FRAME_SECONDS = 1152 / 44100
+SMOOTH_SHOTS = 5
+# Offsets of -e and factors of -m and -s tried by --sweep
+SWEEP_TH = (-12, -6, 0, 6, 12)
+SWEEP_MIN = (0.5, 1, 2)
+SWEEP_SHOTS = (0.5, 1, 2)
+
+
+def load_audio(audiofile):
+    command = 'ffmpeg -nostdin -threads 0 -i "%s" -f s16le -ac 1 -acodec pcm_s16le -ar %d -' % (
+        audiofile, SAMPLE_RATE)
+    process = subprocess.run(shlex.split(command), capture_output=True)
+    if process.returncode != 0:
+        raise ValueError(process.stderr.decode(errors='replace'))
+    return np.frombuffer(process.stdout, np.int16).astype(np.float32) / 32768.0
+
+
+def get_runs(mask):
+    # Start (inclusive) and end (exclusive) indexes of each run of True values
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def get_levels(audio):
+    framelen = int(FRAME_SECONDS * SAMPLE_RATE)
+    nframes = len(audio) // framelen
+
+    # Level is averaged over a few shots so gaps between words are not silence
+    frames = audio[:nframes * framelen].reshape(nframes, framelen)
+    power = np.mean(np.square(frames, dtype=np.float64), axis=1)
+    power = np.convolve(power, np.ones(SMOOTH_SHOTS) / SMOOTH_SHOTS, 'same')
+    return 10 * np.log10(np.maximum(power, 1e-20))
+
+
+def get_profile(args, audiofile):
+    # Levels only depend on the audio so they are kept for the next -c or --sweep
+    profilepath = Path("%s/%s/%s.npz" %
+                       (args.dir, PROFILEDIR, Path(audiofile).stem))
+    stat = Path(audiofile).stat()
+    key = '%d-%d' % (stat.st_size, stat.st_mtime_ns)
+    if profilepath.is_file():
+        profile = np.load(profilepath)
+        if str(profile['key']) == key:
+            return profile['levels'], float(profile['duration'])
+
+    audio = load_audio(audiofile)
+    levels = get_levels(audio)
+    duration = len(audio) / SAMPLE_RATE
+    profilepath.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(profilepath, key=key, levels=levels, duration=duration)
+    return levels, duration
+
+
+def get_silences(levels, th, minsilence, shots):
+    nframes = len(levels)
+    if nframes == 0:
+        return []
+    silent = levels < th
+
+    # Less than shots of non silence between silences is still silence
+    starts, ends = get_runs(~silent)
+    short = ((ends - starts) < shots) & (starts > 0) & (ends < nframes)
+    fill = np.zeros(nframes + 1, np.int64)
+    np.add.at(fill, starts[short], 1)
+    np.add.at(fill, ends[short], -1)
+    silent |= np.cumsum(fill)[:nframes] > 0
+
+    starts, ends = get_runs(silent)
+    valid = (ends - starts) * FRAME_SECONDS >= minsilence
+    return [(float(start * FRAME_SECONDS), float(end * FRAME_SECONDS))
+            for start, end in zip(starts[valid], ends[valid])]
+
+
+def get_segments(audiobase, silences, duration, keep):
+    silences = list(silences)
+
+    # Silence at the start or end trims the audio instead of splitting it
+    start = 0.0
+    end = duration
+    if silences and silences[0][0] <= 0:
+        start = silences.pop(0)[1]
+    if silences and silences[-1][1] >= duration - FRAME_SECONDS:
+        end = np.minimum(silences.pop()[0] + keep, duration)
+    if not silences:
+        return []
+
+    # Same as mp3splt rm=0_keep, keep seconds of silence at each segment end
+    ranges = []
+    for silencestart, silenceend in silences:
+        ranges.append((start, silencestart + keep))
+        start = silenceend
+    ranges.append((start, end))
+
+    width = len(str(len(ranges)))
+    return [{'name': '%s_silence_%0*d' % (audiobase, width, i), 'path': None, 'start': float(start), 'end': float(end)}
+            for i, (start, end) in enumerate(ranges, start=1)]
+
+
+def get_native_segments(args, audiofile, levels, duration, th=None, min=None, shots=None):
+    th = args.th if th is None else th
+    min = args.min if min is None else min
+    shots = args.shots if shots is None else shots
+    silences = get_silences(levels, th, min, shots)
+    return get_segments(Path(audiofile).stem, silences, duration, min)
+
+
+def get_sweep(args):
+    # Grid around the current -e, -m and -s values
+    ths = sorted(set(np.clip([args.th + offset for offset in SWEEP_TH], -96, 0)))
+    mins = sorted(set(args.min * factor for factor in SWEEP_MIN))
+    shots = sorted(set(max(1, int(args.shots * factor))
+                   for factor in SWEEP_SHOTS))
+    return [(int(th), min, shot) for th in ths for min in mins for shot in shots]
+
+
+# --follow decodes and encodes in chunks and holds at most one open segment
+FOLLOW_CHUNK_SECONDS = 10
+FOLLOW_MAX_SECONDS = 600
+
+
+# Stdin output is named after the container in its first bytes
+STREAM_FORMATS = [(b'ID3', '.mp3'), (b'OggS', '.ogg'),
+                  (b'fLaC', '.flac'), (b'RIFF', '.wav')]
+STREAM_HEAD = 12
+
+
+def get_stream_ext(head):
+    for magic, ext in STREAM_FORMATS:
+        if head.startswith(magic):
+            return ext
+    if head[4:8] == b'ftyp':
+        return '.m4a'
+    return '.mp3'
+
+
+def get_follow_command(args, audiofile):
+    # A streamed wav keeps the rate and channels of the source in its header
+    if audiofile == '-':
+        return 'ffmpeg -loglevel error -i pipe:0 -f wav -acodec pcm_s16le -'
+    # The file protocol keeps reading as the file grows until no new data
+    # arrives for rw_timeout microseconds (0 waits forever)
+    return 'ffmpeg -nostdin -loglevel error -follow 1 -rw_timeout %d -i "%s" -f wav -acodec pcm_s16le -' % (
+        int(args.follow * 1000000), audiofile)
+
+
+def get_encode_command(filepath, rate=SAMPLE_RATE, channels=1):
+    return 'ffmpeg -loglevel error -y -f s16le -ac %d -ar %d -i pipe:0 "%s"' % (channels, rate, filepath)
+
+
+def read_wav_header(stream):
+    riff = stream.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        return None
+    rate = channels = None
+    while True:
+        head = stream.read(8)
+        if len(head) < 8:
+            return None
+        size = int.from_bytes(head[4:], 'little')
+        if head[:4] == b'data':
+            return rate, channels
+        body = stream.read(size + size % 2)
+        if head[:4] == b'fmt ':
+            channels = int.from_bytes(body[2:4], 'little')
+            rate = int.from_bytes(body[4:8], 'little')
+
+
+def get_resampler(rate):
+    # Mono at SAMPLE_RATE for splitting and whisper by linear interpolation
+    # after a moving average that damps what would fold back from above
+    # 8 kHz. Positions carry over so chunks join without a seam.
+    step = rate / SAMPLE_RATE
+    width = max(1, int(round(step)))
+    tail = np.zeros(width - 1, np.float32)
+    history = np.zeros(0, np.float32)
+    base = 0
+    position = 0.0
+
+    def resample(mono):
+        nonlocal tail, history, base, position
+        filtered = np.convolve(np.concatenate((tail, mono)),
+                               np.ones(width) / width, 'valid')
+        tail = np.concatenate((tail, mono))[len(mono):]
+        history = np.concatenate((history, filtered))
+        last = base + len(history) - 1
+        if last < position:
+            return np.zeros(0, np.float32)
+        positions = position + step * np.arange(int((last - position) // step) + 1)
+        samples = np.interp(positions - base, np.arange(len(history)), history)
+        position = positions[-1] + step
+        drop = min(int(position) - base, len(history))
+        history = history[drop:]
+        base += drop
+        return samples.astype(np.float32)
+
+    return resample
+
+
+def feed_stream(pipe, head):
+    # Stdin is copied to ffmpeg after the bytes read to name the output
+    try:
+        pipe.write(head)
+        while True:
+            data = sys.stdin.buffer.read1(65536)
+            if not data:
+                break
+            pipe.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def read_stream(args, audiofile, head=b''):
+    # Yields the analysis samples, the source frames and the source rate
+    process = subprocess.Popen(shlex.split(get_follow_command(args, audiofile)), stdout=subprocess.PIPE,
+                               stdin=subprocess.PIPE if audiofile == '-' else subprocess.DEVNULL)
+    if audiofile == '-':
+        threading.Thread(target=feed_stream, args=(
+            process.stdin, head), daemon=True).start()
+    try:
+        header = read_wav_header(process.stdout)
+        if header is None:
+            return
+        rate, channels = header
+        resample = get_resampler(rate)
+        framesize = 2 * channels
+        while True:
+            data = process.stdout.read(FOLLOW_CHUNK_SECONDS * rate * framesize)
+            if not data:
+                break
+            frames = np.frombuffer(data[:len(data) // framesize * framesize],
+                                   np.int16).reshape(-1, channels)
+            yield resample(frames.mean(axis=1, dtype=np.float32) / 32768.0), frames, rate
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+def get_stream_segments(args, audiobase, chunks):
+    framelen = int(FRAME_SECONDS * SAMPLE_RATE)
+    buffer = np.zeros(0, np.float32)
+    offset = 0
+    count = 0
+
+    # None marks the end of the stream
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        if not final:
+            buffer = np.concatenate((buffer, chunk))
+
+        while len(buffer) >= framelen:
+            levels = get_levels(buffer)
+            silences = get_silences(levels, args.th, args.min, args.shots)
+            if not final:
+                # A silence is closed once enough sound follows that it can
+                # neither grow nor be joined with the next one
+                silences = [silence for silence in silences
+                            if round(silence[1] / FRAME_SECONDS) + args.shots + SMOOTH_SHOTS <= len(levels)]
+
+            if silences:
+                # Cut at frame boundaries so later levels line up
+                start, end = silences[0]
+                stop = int(round(end / FRAME_SECONDS)) * framelen
+                keep = 0 if start <= 0 else min(
+                    int((start + args.min) * SAMPLE_RATE), len(buffer))
+            elif final or len(buffer) >= FOLLOW_MAX_SECONDS * SAMPLE_RATE:
+                stop = keep = len(buffer)
+            else:
+                break
+
+            if keep:
+                count += 1
+                segment = {'name': '%s_silence_%d' % (audiobase, count), 'path': None,
+                           'start': offset / SAMPLE_RATE, 'end': (offset + keep) / SAMPLE_RATE}
+                yield segment, buffer[:keep]
+            buffer = buffer[stop:]
+            offset += stop
+
+
+def get_duration(filepath):
+    # Container headers are read in-process and sox only decodes formats
+    # mutagen does not know
+    import mutagen
+
+    info = mutagen.File(filepath)
+    if info is not None and info.info.length:
+        return info.info.length
+
+    import sox
+    return sox.file_info.duration(filepath)
+
+
+def get_durations(audiofile, noadsfile=None):
     audiodt = datetime.timedelta(milliseconds=int(
-        sox.file_info.duration(audiofile)*1000))
+        get_duration(audiofile)*1000))
 
     if noadsfile is None:
         noadsdt = datetime.timedelta(milliseconds=0)
     else:
         noadsdt = datetime.timedelta(milliseconds=int(
-            sox.file_info.duration(noadsfile)*1000))
+            get_duration(noadsfile)*1000))
+
+    return audiodt, noadsdt
+
+
+def get_confidence(data):
+    # Only the cascade has a probability. Keyword weight sums and
+    # fingerprint votes are unbounded so they are kept as a separate score.
+    if data.get('llm') == 'cascade':
+        return max(data['probability'], 1 - data['probability'])
+    return None
+
+
+def get_score(data):
+    if data.get('llm') in ('keyword', 'fingerprint'):
+        return data.get('score', 1.0)
+    return None
+
+
+def get_stats(audiofile, adcount, audiodt, noadsdt, segments=None):
+    stats = {'audiofile': audiofile,
+             'ads': adcount,
+             'duration': audiodt.total_seconds(),
+             'noads_duration': noadsdt.total_seconds(),
+             'ad_duration': (audiodt - noadsdt).total_seconds(),
+             'ads_per_minute': adcount / (audiodt.total_seconds() / 60),
+             'ad_percent': float(100-noadsdt/audiodt*100) if adcount > 0 else 0.0}
+    if segments is not None:
+        stats['segments'] = segments
+    return stats
+
+
+def write_stats(args, audiobase, stats):
+    statspath = Path("%s/%s_stats.json" % (args.dir, audiobase))
+    statspath.write_text(json.dumps(stats, indent=2))
+    return statspath
 
+
+def format_ads_stats(adcount, audiodt, noadsdt):
     adsdt = audiodt - noadsdt
-    adspermin = adcount / (audiodt.seconds / 60)
+    adspermin = adcount / (audiodt.total_seconds() / 60)
     adspercent = 0
     avgadsdt = 0
     if adcount > 0:
@@ -123,16 +705,27 @@ def get_ads_stats(audiofile, adcount, noadsfile=None):
     return stats
 
 
-def get_noads_file(audiofile, dir, concatstr):
+def get_concat_entry(audiofile, segment):
+    if segment['path'] is not None:
+        return "file '%s'\n" % str(segment['path'].resolve())
+
+    # Native segments are cut from the original audio
+    entry = "file '%s'\n" % str(Path(audiofile).resolve())
+    entry += 'inpoint %.3f\n' % segment['start']
+    entry += 'outpoint %.3f\n' % segment['end']
+    return entry
+
+
+def get_noads_file(audiofile, dir, concatstr, suffix='noads'):
     noadsaudio = None
     if concatstr:
         audiobase = Path(audiofile).stem
         audioext = Path(audiofile).suffix
-        concatpath = Path("%s/%s_noads.txt" %
-                          (dir, audiobase)).resolve()
+        concatpath = Path("%s/%s_%s.txt" %
+                          (dir, audiobase, suffix)).resolve()
         concatpath.write_text(concatstr)
-        noadsaudio = str(Path("%s/%s_noads%s" %
-                              (dir, audiobase, audioext)).resolve())
+        noadsaudio = str(Path("%s/%s_%s%s" %
+                              (dir, audiobase, suffix, audioext)).resolve())
         ffmpeg = get_concat_command(concatpath, noadsaudio)
         process = subprocess.Popen(shlex.split(ffmpeg), cwd=dir)
         process.wait()
@@ -141,128 +734,485 @@ def get_noads_file(audiofile, dir, concatstr):
     return noadsaudio
 
 
+def get_render_command(audiofile, outputs):
+    # One decode of the original audio feeds a sample accurate selection of
+    # ranges for each output
+    graph = '[0:a]asplit=%d%s;' % (
+        len(outputs), ''.join('[in%d]' % i for i in range(len(outputs))))
+    maps = ''
+    for i, (ranges, filepath) in enumerate(outputs):
+        select = '+'.join('between(t,%.3f,%.3f)' % (start, end)
+                          for start, end in ranges)
+        graph += "[in%d]aselect='%s',asetpts=N/SR/TB[out%d];" % (
+            i, select, i)
+        maps += ' -map "[out%d]" "%s"' % (i, filepath)
+    return 'ffmpeg -nostdin -y -hide_banner -loglevel error -i "%s" -filter_complex "%s"%s' % (
+        audiofile, graph.rstrip(';'), maps)
+
+
+def render_ranges(args, audiofile, keepranges, adranges):
+    audiobase = Path(audiofile).stem
+    audioext = Path(audiofile).suffix
+    noadsaudio = None
+    outputs = []
+    if keepranges:
+        noadsaudio = str(Path("%s/%s_noads%s" %
+                              (args.dir, audiobase, audioext)).resolve())
+        outputs.append((keepranges, noadsaudio))
+    if args.ads_file and adranges:
+        outputs.append((adranges, str(Path("%s/%s_ads%s" %
+                                           (args.dir, audiobase, audioext)).resolve())))
+
+    if outputs:
+        # ffmpeg runs in the working directory so the input path is absolute
+        process = subprocess.Popen(shlex.split(
+            get_render_command(str(Path(audiofile).resolve()), outputs)), cwd=args.dir)
+        returncode = process.wait()
+        if returncode != 0:
+            print('Could not render "%s" without ads.' %
+                  audiofile, file=sys.stderr)
+            exit(1)
+
+    return noadsaudio
+
+
+def get_cue_time(seconds):
+    # mm:ss:ff with 75 frames per second
+    frames = int(round(seconds * 75))
+    return '%02d:%02d:%02d' % (frames // 4500, frames // 75 % 60, frames % 75)
+
+
+def write_cue(args, audiofile, tracks):
+    cue = 'FILE "%s" %s\n' % (Path(audiofile).name,
+                              Path(audiofile).suffix.lstrip('.').upper())
+    for number, (start, title) in enumerate(tracks, start=1):
+        cue += '  TRACK %02d AUDIO\n' % number
+        cue += '    TITLE "%s"\n' % title
+        cue += '    INDEX 01 %s\n' % get_cue_time(start)
+    cuepath = Path("%s/%s.cue" % (args.dir, Path(audiofile).stem))
+    cuepath.write_text(cue)
+    return cuepath
+
+
+def get_genai():
+    # RMADS_GENAI names a stand-in client module for offline tests
+    return importlib.import_module(os.environ.get('RMADS_GENAI', 'google.generativeai'))
+
+
 # https://ai.google.dev/gemini-api/docs/safety-settings
-SAFETY_SETTINGS = {
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE
-}
+def get_safety_settings():
+    types = get_genai().types
+    HarmCategory, HarmBlockThreshold = types.HarmCategory, types.HarmBlockThreshold
+    return {
+        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE
+    }
+
 
 # https://ai.google.dev/api/generate-content#generationconfig
-GENERATION_CONFIG = genai.types.GenerationConfig(
-    # https://ai.google.dev/gemini-api/docs/models/generative-models#model-parameters
-    temperature=0.0,
-    top_k=40,
-    top_p=0.95,
-    max_output_tokens=4,
-    response_mime_type='text/plain')
+def get_generation_config(max_output_tokens=4):
+    return get_genai().types.GenerationConfig(
+        # https://ai.google.dev/gemini-api/docs/models/generative-models#model-parameters
+        temperature=0.0,
+        top_k=40,
+        top_p=0.95,
+        max_output_tokens=max_output_tokens,
+        response_mime_type='text/plain')
+
+
+# Gemini calls share one token bucket per model
+RATE_LIMITERS = {}
+RETRIES = 5
+BACKOFF = 2.0
+
+
+class RateLimiter:
+
+    def __init__(self, name, rpm, tpm):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.throttled = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens=0):
+        tokens = min(tokens, self.tpm)
+        with self.lock:
+            while True:
+                self.refill()
+                rpmwait = (1 - self.requests) * 60 / self.rpm
+                tpmwait = (tokens - self.tokens) * 60 / self.tpm
+                if rpmwait <= 0 and tpmwait <= 0:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+
+                if rpmwait >= tpmwait:
+                    wait, reason = rpmwait, 'rpm = %g' % self.rpm
+                else:
+                    wait, reason = tpmwait, 'tpm = %g' % self.tpm
+                print('Waiting for %.1f seconds to call %s because %s' %
+                      (wait, self.name, reason))
+                with timed('throttle', llm=self.name, reason=reason):
+                    time.sleep(wait)
+                self.throttled += wait
+                count_metric('throttle_seconds', wait)
+
+    def backoff(self, seconds):
+        # Only the retry is left in the bucket once the server rejects a request
+        with self.lock:
+            with timed('throttle', llm=self.name, reason='backoff'):
+                time.sleep(seconds)
+            self.throttled += seconds
+            count_metric('throttle_seconds', seconds)
+            self.requests = 1.0
+            self.updated = time.monotonic()
+
+
+def get_rate_limiter(args, name):
+    if name not in RATE_LIMITERS:
+        # Rate limits for gemini (https://ai.google.dev/gemini-api/docs/rate-limits)
+        if name == 'gemini-1.5-pro':
+            rpm = 2
+        else:
+            rpm = 15
+        if name in ['gemini-pro', 'gemini-1.5-pro']:
+            tpm = 32000
+        else:
+            tpm = 1000000
+
+        # Override rpm and tpm
+        if args.rpm is not None:
+            rpm = args.rpm
+        if args.tpm is not None:
+            tpm = args.tpm
+
+        # Worker processes split the budget between them
+        RATE_LIMITERS[name] = RateLimiter(
+            name, rpm / args.jobs, tpm / args.jobs)
+
+    return RATE_LIMITERS[name]
+
+
+def get_retry_after(e):
+    match = re.search(r'retry_delay\s*{\s*seconds:\s*(\d+)|retry in ([\d.]+)s',
+                      str(e), re.IGNORECASE)
+    if match:
+        return float(match.group(1) or match.group(2))
+    return 0.0
+
+
+def gemini_generate(args, name, model, contents, tokens=None, **kwargs):
+    limiter = get_rate_limiter(args, name)
+
+    if tokens is None:
+        # Roughly 4 characters per token
+        tokens = sum(len(content) // 4 for content in contents
+                     if isinstance(content, str))
+        if 'generation_config' in kwargs:
+            tokens += kwargs['generation_config'].max_output_tokens or 0
+
+    for attempt in range(RETRIES + 1):
+        limiter.acquire(tokens)
+        try:
+            response = model.generate_content(contents, **kwargs)
+            # Estimated tokens stand in when the response has no usage
+            usage = getattr(response, 'usage_metadata', None)
+            count_metric('llm_tokens', getattr(usage, 'total_token_count', None) or tokens)
+            return response
+        except Exception as e:
+            # 429 Resource has been exhausted
+            if getattr(e, 'code', None) != 429 or attempt == RETRIES:
+                raise
+            wait = max(get_retry_after(e), BACKOFF * 2 ** attempt)
+            print('Rate limited by %s. Retrying in %.1f seconds...' %
+                  (name, wait))
+            limiter.backoff(wait)
+
+
+def get_throttle_stats():
+    stats = ''
+    for limiter in RATE_LIMITERS.values():
+        if limiter.throttled > 0:
+            stats += 'Throttled %s for %.1f seconds\n' % (
+                limiter.name, limiter.throttled)
+    return stats
 
 
-def gemini_audio(args, audiofile, adslog=None, noadslog=None):
+# Long audio is sent to -G in overlapping windows queried in parallel
+GEMINI_OVERLAP = 30
+GEMINI_WORKERS = 4
+# Non ad ranges closer than this are joined and shorter gaps are not ads
+GEMINI_MIN_AD = 1.0
 
-    gemini_audio_file = None
-    print('Calling gemini using "%s"...' % audiofile)
 
-    outlog = 'audio="%s" llm="%s"\n\n' % (audiofile, args.gemini_audio)
-    if adslog:
-        adslog.write(outlog)
-        adslog.flush()
-    if noadslog:
-        noadslog.write(outlog)
-        noadslog.flush()
+def get_window_command(audiofile, start, length, filepath):
+    return 'ffmpeg -nostdin -y -hide_banner -loglevel error -ss %.3f -t %.3f -i "%s" -vn -c copy "%s"' % (
+        start, length, audiofile, filepath)
+
+
+def get_windows(duration, window):
+    if window <= 0 or duration <= window:
+        return [(0.0, duration, 0.0, duration)]
+
+    # Each window answers for its range minus half of each overlap so the
+    # model always hears some context around a boundary
+    overlap = min(GEMINI_OVERLAP, window / 4)
+    step = window - overlap
+    count = int(math.ceil((duration - overlap) / step))
+    windows = []
+    for i in range(count):
+        start = i * step
+        end = min(start + window, duration)
+        ownstart = 0.0 if i == 0 else start + overlap / 2
+        ownend = duration if i == count - 1 else end - overlap / 2
+        windows.append((start, end, ownstart, ownend))
+    return windows
+
 
+def parse_timestamp(value):
+    # %H:%M:%S.%f with optional hours
     try:
-        audiobase = Path(audiofile).stem
-        # File name may only contain lowercase alphanumeric characters or dashes
-        name = re.sub("[^A-Za-z0-9/-]", "",
-                      audiobase.replace('_', '-')).lower()
-        # can not be more than 40 characters
-        name = name[:40]
-        # can not begin or end with dash
-        name = name.lstrip('-').rstrip('-')
+        seconds = 0.0
+        for part in value.strip().split(':'):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    except ValueError:
+        return None
+
+
+def parse_ranges(text):
+    ranges = []
+    for line in text.splitlines():
+        values = line.split(' ', maxsplit=2)
+        if len(values) != 2:
+            continue
+        start, end = parse_timestamp(values[0]), parse_timestamp(values[1])
+        if start is not None and end is not None and end > start:
+            ranges.append((start, end))
+    return ranges
 
-        if args.purge:
-            gemini_audio_file = genai.get_file(name)
-            genai.delete_file(gemini_audio_file)
-            print('Purged "%s" in gemini audio' %
-                  gemini_audio_file.display_name)
 
-        if args.purge_all:
-            for f in genai.list_files():
-                genai.delete_file(f)
-                print('Purged "%s" in gemini audio' % f.display_name)
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start - merged[-1][1] < GEMINI_MIN_AD:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def get_gaps(ranges, duration):
+    # Every gap between non ad ranges is one ad
+    edges = [0.0] + [value for span in ranges for value in span] + [duration]
+    return [(start, end) for start, end in zip(edges[::2], edges[1::2])
+            if end - start >= GEMINI_MIN_AD]
+
+
+# Uploads are listed in a manifest keyed by content hash until they expire
+GEMINI_MANIFEST = 'gemini.json'
+GEMINI_TTL = 48 * 3600
+GEMINI_MARGIN = 3600
+MANIFEST_LOCK = threading.Lock()
+
+
+def get_manifest_path(args):
+    # Shared with other working directories when there is a --cache
+    return Path("%s/%s" % (args.cache or args.dir, GEMINI_MANIFEST))
+
 
-        gemini_audio_file = genai.get_file(name)
-    except:
-        gemini_audio_file = genai.upload_file(path=audiofile, name=name)
+def load_manifest(args):
+    path = get_manifest_path(args)
+    if not path.is_file():
+        return {}
+    return json.loads(path.read_text())
+
+
+def update_manifest(args, updates):
+    # Re-read under the lock so windows uploaded in parallel are all kept
+    with MANIFEST_LOCK:
+        manifest = load_manifest(args)
+        for key, entry in updates.items():
+            if entry is None:
+                manifest.pop(key, None)
+            else:
+                manifest[key] = entry
+        path = get_manifest_path(args)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = path.with_name('%s.%d.tmp' % (path.name, os.getpid()))
+        tmppath.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmppath, path)
+
+
+def get_file_hash(audiofile):
+    digest = hashlib.sha256()
+    with open(audiofile, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_upload_key(filehash, window):
+    return '%s-%.3f-%.3f' % (filehash, window[0], window[1])
+
+
+def get_uploaded_file(args, key, path, display_name):
+    entry = load_manifest(args).get(key)
+    if entry and entry['expires'] > time.time() + GEMINI_MARGIN:
+        if args.verbose:
+            print('Using uploaded "%s" for "%s"' % (entry['name'], display_name))
+        return {'file_data': {'mime_type': entry['mime_type'], 'file_uri': entry['uri']}}
+
+    # Missing or about to expire
+    gemini_audio_file = get_genai().upload_file(
+        path=path(), display_name=display_name)
+    expires = getattr(gemini_audio_file, 'expiration_time', None)
+    update_manifest(args, {key: {
+        'name': gemini_audio_file.name,
+        'uri': gemini_audio_file.uri,
+        'mime_type': gemini_audio_file.mime_type,
+        'display_name': display_name,
+        'expires': expires.timestamp() if expires else time.time() + GEMINI_TTL}})
+    return gemini_audio_file
+
+
+def gemini_window(args, audiofile, filehash, windows, index, tmpdir):
+    genai = get_genai()
+    start, end, ownstart, ownend = windows[index]
+    audiobase = Path(audiofile).stem
+    if len(windows) > 1:
+        audiobase = '%s-w%03d' % (audiobase, index + 1)
+        print('Calling gemini using "%s" %.1f-%.1f...' %
+              (audiofile, start, end))
+    else:
+        print('Calling gemini using "%s"...' % audiofile)
+
+    # Windows are only cut when they need to be uploaded
+    def get_path():
+        if len(windows) == 1:
+            return audiofile
+        path = '%s/%s%s' % (tmpdir, audiobase, Path(audiofile).suffix)
+        subprocess.run(shlex.split(get_window_command(
+            audiofile, start, end - start, path)), check=True)
+        return path
+
+    gemini_audio_file = get_uploaded_file(args, get_upload_key(filehash, windows[index]),
+                                          get_path, audiobase)
 
     if args.verbose:
         print(gemini_audio_file)
 
-    try:
-        instruction = 'Provide only timestamps ranges in the format "%H:%M:%S.%f %H:%M:%S.%f"'
-        prompts = [
-            'What are the timestamps for the segments of this audio that do not contain advertisements?',
-        ]
+    instruction = 'Provide only timestamps ranges in the format "%H:%M:%S.%f %H:%M:%S.%f"'
+    prompt = 'What are the timestamps for the segments of this audio that do not contain advertisements?'
 
-        model = genai.GenerativeModel(
-            args.gemini_audio, system_instruction=instruction)
+    model = genai.GenerativeModel(
+        args.gemini_audio, system_instruction=instruction)
 
-        if args.verbose:
-            print(str(model.count_tokens([gemini_audio_file])))
+    tokens = model.count_tokens([gemini_audio_file])
+    if args.verbose:
+        print(str(tokens))
 
-        audio_generation_config = GENERATION_CONFIG
-        audio_generation_config.max_output_tokens = 8096
-        response = model.generate_content(
-            [prompts[0], gemini_audio_file],
-            safety_settings=SAFETY_SETTINGS,
+    audio_generation_config = get_generation_config(8096)
+    with timed('classify', audiofile=audiofile, window=index):
+        response = gemini_generate(
+            args, args.gemini_audio, model,
+            [prompt, gemini_audio_file],
+            tokens=tokens.total_tokens + audio_generation_config.max_output_tokens,
+            safety_settings=get_safety_settings(),
             generation_config=audio_generation_config)
 
-        concatstr = ''
-        fullpath = str(Path(audiofile).resolve())
+    # Shift to absolute time and keep only the range this window answers for
+    ranges = []
+    for rangestart, rangeend in parse_ranges(response.text):
+        rangestart = max(rangestart + start, ownstart)
+        rangeend = min(rangeend + start, ownend)
+        if rangeend > rangestart:
+            ranges.append((rangestart, rangeend))
+    return ranges
 
-        print('Response =')
 
-        lines = response.text.splitlines()
-        for line in lines:
-
-            values = line.split(' ', maxsplit=2)
-            if len(values) != 2:
-                continue
+def gemini_audio(args, audiofile, adslog=None, noadslog=None):
 
-            start = values[0]
-            end = values[1]
+    genai = get_genai()
 
-            outlog = '%s %s - not ad' % (start, end)
-            if noadslog:
-                noadslog.write(outlog + '\n')
-            print(outlog)
+    outlog = 'audio="%s" llm="%s"\n\n' % (audiofile, args.gemini_audio)
+    if adslog:
+        adslog.write(outlog)
+        adslog.flush()
+    if noadslog:
+        noadslog.write(outlog)
+        noadslog.flush()
 
-            concatstr += "file '%s'\n" % fullpath
-            concatstr += 'inpoint %s\n' % start
-            concatstr += 'outpoint %s\n' % end
+    audiodt, _ = get_durations(audiofile)
+    duration = audiodt.total_seconds()
+    windows = get_windows(duration, args.gemini_window)
+    filehash = get_file_hash(audiofile)
 
-        noadsaudio = get_noads_file(audiofile, args.dir, concatstr)
+    try:
+        if args.purge:
+            manifest = load_manifest(args)
+            keys = [key for key in manifest if key.startswith(filehash)]
+            for key in keys:
+                if manifest[key]['expires'] > time.time():
+                    genai.delete_file(manifest[key]['name'])
+                print('Purged "%s" in gemini audio' %
+                      manifest[key]['display_name'])
+            update_manifest(args, dict.fromkeys(keys))
 
+        if args.purge_all:
+            for f in genai.list_files():
+                genai.delete_file(f)
+                print('Purged "%s" in gemini audio' % f.display_name)
+            update_manifest(args, dict.fromkeys(load_manifest(args)))
     except Exception as e:
         print(e, file=sys.stderr)
         exit(1)
 
     try:
-        instruction = 'Provide only an integer'
-        prompt = 'How many separate advertisements are in this audio?'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(GEMINI_WORKERS, len(windows))) as executor:
+                futures = [executor.submit(gemini_window, args, audiofile, filehash, windows, index, tmpdir)
+                           for index in range(len(windows))]
+                ranges = merge_ranges([span for future in futures
+                                       for span in future.result()])
 
-        model = genai.GenerativeModel(
-            args.gemini_audio, system_instruction=instruction)
+        print('Response =')
 
-        response = model.generate_content(
-            [prompt, gemini_audio_file],
-            safety_settings=SAFETY_SETTINGS,
-            generation_config=GENERATION_CONFIG)
+        for start, end in ranges:
+            outlog = '%s %s - not ad' % (datetime.timedelta(seconds=start),
+                                         datetime.timedelta(seconds=end))
+            if noadslog:
+                noadslog.write(outlog + '\n')
+            print(outlog)
 
-        count = int(response.text)
-        adsout = get_ads_stats(audiofile, count, noadsaudio)
+        # Ads are the gaps between non ad ranges instead of a second request
+        gaps = get_gaps(ranges, duration)
+        count = len(gaps)
+        with timed('render', audiofile=audiofile):
+            noadsaudio = render_ranges(args, audiofile, ranges, gaps)
+        if args.cue:
+            write_cue(args, audiofile, sorted([(start, 'Content') for start, end in ranges] +
+                                              [(start, 'Ad') for start, end in gaps]))
+        noadsdt = datetime.timedelta(
+            milliseconds=int(sum(end - start for start, end in ranges) * 1000))
+        adsout = format_ads_stats(count, audiodt, noadsdt)
+        write_stats(args, Path(audiofile).stem, get_stats(audiofile, count, audiodt, noadsdt, sorted(
+            [{'start': start, 'end': end, 'duration': end - start, 'response': 'NO'} for start, end in ranges] +
+            [{'start': start, 'end': end, 'duration': end - start, 'response': 'YES'} for start, end in gaps],
+            key=lambda segment: segment['start'])))
         if adslog:
             adslog.write(adsout)
         print(adsout)
@@ -276,19 +1226,1293 @@ def gemini_audio(args, audiofile, adslog=None, noadslog=None):
         print(e, file=sys.stderr)
         exit(1)
 
+    return {'audiofile': audiofile, 'ads': count, 'audio': audiodt, 'noads': noadsdt}
 
-def main(args=None):
 
-    global SEP
-    SEP = '=========='
-    SPLITDIR = 'mp3splt'
-    WHISPDIR = 'whisper'
-    LLMDIR = 'llm'
+# Segments waiting between the transcribe and classify stages
+QUEUE_SIZE = 4
+
+
+def get_cache_path(args, kind, key):
+    return Path(args.cache) / kind / key[:2] / key
+
+
+def get_audio_key(args, audio):
+    # Same samples with the same whisper settings give the same text
+    key = hashlib.sha256(np.ascontiguousarray(audio).tobytes())
+    key.update(('\n%s\n%s' % (args.whisper, args.lang)).encode())
+    return key.hexdigest()
+
+
+def get_text_key(llm, text):
+    return hashlib.sha256(('%s\n%s\n%s' % (llm, INSTRUCTION, get_prompt(text))).encode()).hexdigest()
+
+
+def cache_get(args, kind, key):
+    if not args.cache:
+        return None
+    path = get_cache_path(args, kind, key)
+    try:
+        text = path.read_text()
+        # Least recently used entries are evicted first
+        os.utime(path)
+        count_metric('%s_cache_hits' % kind)
+        return text
+    except FileNotFoundError:
+        return None
+
+
+def cache_put(args, kind, key, text):
+    if not args.cache:
+        return
+    path = get_cache_path(args, kind, key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temppath = path.with_name('%s.%d' % (key, os.getpid()))
+    temppath.write_text(text)
+    os.replace(temppath, path)
+
+
+def evict_cache(args):
+    if not args.cache:
+        return
+    entries = []
+    for path in Path(args.cache).glob('*/*/*'):
+        try:
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+        except FileNotFoundError:
+            pass
+
+    size = sum(entry[1] for entry in entries)
+    for mtime, entrysize, path in sorted(entries):
+        if size <= args.cache_size * 1024 * 1024:
+            break
+        path.unlink(missing_ok=True)
+        size -= entrysize
+        if args.verbose:
+            print("Removed %s" % path)
+
+
+# Segment progress is kept in whisper/*.txt and llm/*.json files or, with
+# --store, in a single sqlite file indexed by audio file and segment
+STORE = threading.local()
+
+
+def get_connection(path, schema):
+    if not hasattr(STORE, 'connections'):
+        STORE.connections = {}
+    path = str(Path(path).resolve())
+    # Connections are never shared between threads or worker processes
+    key = (os.getpid(), path)
+    if key not in STORE.connections:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(path, timeout=60)
+        connection.execute('PRAGMA journal_mode=WAL')
+        for statement in schema:
+            connection.execute(statement)
+        connection.commit()
+        STORE.connections[key] = connection
+    return STORE.connections[key]
+
+
+def get_store(args):
+    return get_connection("%s/%s" % (args.dir, STOREDB), [
+        'CREATE TABLE IF NOT EXISTS segments (audio TEXT NOT NULL, segment TEXT NOT NULL, text TEXT, response TEXT, PRIMARY KEY (audio, segment))',
+        'CREATE TABLE IF NOT EXISTS runs (audio TEXT PRIMARY KEY, params TEXT NOT NULL)'])
+
+
+def get_text(args, audiobase, splitbase):
+    if args.store:
+        row = get_store(args).execute('SELECT text FROM segments WHERE audio = ? AND segment = ?',
+                                      (audiobase, splitbase)).fetchone()
+        return row[0] if row else None
+
+    txtpath = Path("%s/%s/%s.txt" % (args.dir, WHISPDIR, splitbase))
+    return txtpath.read_text() if txtpath.is_file() else None
+
+
+def put_text(args, audiobase, splitbase, text):
+    if args.store:
+        with get_store(args) as connection:
+            connection.execute('INSERT INTO segments (audio, segment, text) VALUES (?, ?, ?) ON CONFLICT (audio, segment) DO UPDATE SET text = excluded.text',
+                               (audiobase, splitbase, text))
+        return
+
+    Path("%s/%s/%s.txt" % (args.dir, WHISPDIR, splitbase)).write_text(text)
+
+
+def get_response(args, audiobase, splitbase):
+    if args.store:
+        row = get_store(args).execute('SELECT response FROM segments WHERE audio = ? AND segment = ?',
+                                      (audiobase, splitbase)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    jsonpath = Path("%s/%s/%s.json" % (args.dir, LLMDIR, splitbase))
+    return json.loads(jsonpath.read_text()) if jsonpath.is_file() else None
+
+
+def put_response(args, audiobase, splitbase, data):
+    if args.store:
+        with get_store(args) as connection:
+            connection.execute('INSERT INTO segments (audio, segment, response) VALUES (?, ?, ?) ON CONFLICT (audio, segment) DO UPDATE SET response = excluded.response',
+                               (audiobase, splitbase, json.dumps(data)))
+        return
+
+    Path("%s/%s/%s.json" % (args.dir, LLMDIR, splitbase)
+         ).write_text(json.dumps(data, indent=2))
+
+
+def delete_segment(args, audiobase, splitbase):
+    if args.store:
+        with get_store(args) as connection:
+            connection.execute('DELETE FROM segments WHERE audio = ? AND segment = ?',
+                               (audiobase, splitbase))
+        return
+
+    Path("%s/%s/%s.txt" % (args.dir, WHISPDIR, splitbase)
+         ).unlink(missing_ok=True)
+    Path("%s/%s/%s.json" % (args.dir, LLMDIR, splitbase)
+         ).unlink(missing_ok=True)
+
+
+def purge_segments(args, audiobase):
+    if args.store:
+        with get_store(args) as connection:
+            connection.execute(
+                'DELETE FROM segments WHERE audio = ?', (audiobase,))
+        return
+
+    pattern = '%s_silence_*' % glob.escape(audiobase)
+    for path in [*Path("%s/%s" % (args.dir, WHISPDIR)).glob('%s.txt' % pattern),
+                 *Path("%s/%s" % (args.dir, LLMDIR)).glob('%s.json' % pattern)]:
+        path.unlink()
+
+
+def purge_store(args, audiobase):
+    with get_store(args) as connection:
+        connection.execute(
+            'DELETE FROM segments WHERE audio = ?', (audiobase,))
+        connection.execute('DELETE FROM runs WHERE audio = ?', (audiobase,))
+
+
+def put_run(args, audiobase, params):
+    if args.store:
+        with get_store(args) as connection:
+            connection.execute('INSERT OR REPLACE INTO runs (audio, params) VALUES (?, ?)',
+                               (audiobase, json.dumps(params)))
+
+
+def migrate_store(args):
+    # Segment files are named <audio>_silence_<segment>
+    texts = [(path.stem.rsplit('_silence_', 1)[0], path.stem, path.read_text())
+             for path in Path("%s/%s" % (args.dir, WHISPDIR)).glob('*_silence_*.txt')]
+    responses = [(path.stem.rsplit('_silence_', 1)[0], path.stem, json.dumps(json.loads(path.read_text())))
+                 for path in Path("%s/%s" % (args.dir, LLMDIR)).glob('*_silence_*.json')]
+
+    with get_store(args) as connection:
+        connection.executemany('INSERT INTO segments (audio, segment, text) VALUES (?, ?, ?) ON CONFLICT (audio, segment) DO UPDATE SET text = excluded.text',
+                               texts)
+        connection.executemany('INSERT INTO segments (audio, segment, response) VALUES (?, ?, ?) ON CONFLICT (audio, segment) DO UPDATE SET response = excluded.response',
+                               responses)
+
+    print('Migrated %d texts and %d responses to "%s/%s"' %
+          (len(texts), len(responses), args.dir, STOREDB))
+
+
+def write_response(args, audiobase, splitbase, data):
+    put_response(args, audiobase, splitbase, data)
+    cache_put(args, LLMDIR, get_text_key(
+        data['llm'], get_text(args, audiobase, splitbase)), json.dumps(data, indent=2))
 
-    args = get_args()
+
+# Segments decided YES are indexed by hashes of pairs of spectral peaks so
+# repeats of the same ad are found without whisper or the llm
+FINGERPRINTDB = 'fingerprint.db'
+FINGERPRINT_FFT = 512
+FINGERPRINT_HOP = 256
+FINGERPRINT_NEIGHBOURHOOD = 10
+FINGERPRINT_FANOUT = 5
+FINGERPRINT_MAX_DT = 63
+FINGERPRINT_MATCHES = 20
+
+
+def get_segment_samples(segment, audio=None):
+    if segment['path'] is None:
+        return audio[int(segment['start'] * SAMPLE_RATE):int(segment['end'] * SAMPLE_RATE)]
+    return load_audio(str(segment['path']))
+
+
+def max_filter(values, size, axis):
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (size, size)
+    padded = np.pad(values, pad, constant_values=-np.inf)
+    return np.lib.stride_tricks.sliding_window_view(padded, 2 * size + 1, axis=axis).max(axis=-1)
+
+
+def get_peaks(samples):
+    if len(samples) < FINGERPRINT_FFT:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+    frames = np.lib.stride_tricks.sliding_window_view(
+        samples, FINGERPRINT_FFT)[::FINGERPRINT_HOP]
+    spectrum = np.log(np.abs(np.fft.rfft(
+        frames * np.hanning(FINGERPRINT_FFT), axis=1)) + 1e-10)
+
+    # A peak is the loudest point of its time and frequency neighbourhood
+    local = max_filter(max_filter(spectrum, FINGERPRINT_NEIGHBOURHOOD, 1),
+                       FINGERPRINT_NEIGHBOURHOOD, 0)
+    times, freqs = np.nonzero((spectrum == local) &
+                              (spectrum > spectrum.mean()))
+    return times, freqs
+
+
+def get_hashes(samples):
+    times, freqs = get_peaks(samples)
+    hashes = []
+    for i in range(len(times)):
+        for j in range(i + 1, min(i + 1 + FINGERPRINT_FANOUT, len(times))):
+            dt = times[j] - times[i]
+            if dt > FINGERPRINT_MAX_DT:
+                break
+            if dt > 0:
+                hashes.append(
+                    (int(freqs[i]) << 15 | int(freqs[j]) << 6 | int(dt), int(times[i])))
+    return hashes
+
+
+def get_fingerprint_path(args):
+    # Shared with other working directories when there is a --cache
+    return Path("%s/%s" % (args.cache or args.dir, FINGERPRINTDB))
+
+
+def get_fingerprint_db(args):
+    return get_connection(get_fingerprint_path(args), [
+        'CREATE TABLE IF NOT EXISTS fingerprints (id INTEGER PRIMARY KEY, audio TEXT NOT NULL, segment TEXT NOT NULL, UNIQUE (audio, segment))',
+        'CREATE TABLE IF NOT EXISTS hashes (hash INTEGER NOT NULL, fingerprint INTEGER NOT NULL, offset INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS hashes_hash ON hashes (hash)'])
+
+
+def add_fingerprint(args, audiobase, splitbase, samples):
+    db = get_fingerprint_db(args)
+    if db.execute('SELECT 1 FROM fingerprints WHERE audio = ? AND segment = ?',
+                  (audiobase, splitbase)).fetchone():
+        return
+
+    hashes = get_hashes(samples)
+    with db:
+        cursor = db.execute('INSERT INTO fingerprints (audio, segment) VALUES (?, ?)',
+                            (audiobase, splitbase))
+        db.executemany('INSERT INTO hashes (hash, fingerprint, offset) VALUES (?, ?, ?)',
+                       [(hash, cursor.lastrowid, offset) for hash, offset in hashes])
+
+
+def delete_fingerprint(args, audiobase, splitbase):
+    db = get_fingerprint_db(args)
+    with db:
+        row = db.execute('SELECT id FROM fingerprints WHERE audio = ? AND segment = ?',
+                         (audiobase, splitbase)).fetchone()
+        if row:
+            db.execute('DELETE FROM hashes WHERE fingerprint = ?', row)
+            db.execute('DELETE FROM fingerprints WHERE id = ?', row)
+
+
+def match_fingerprint(args, samples):
+    offsets = {}
+    for hash, offset in get_hashes(samples):
+        offsets.setdefault(hash, []).append(offset)
+    if not offsets:
+        return None
+
+    # Matching hashes of the same ad line up at one time difference
+    db = get_fingerprint_db(args)
+    votes = collections.Counter()
+    hashes = list(offsets)
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        rows = db.execute('SELECT hash, fingerprint, offset FROM hashes WHERE hash IN (%s)' %
+                          ','.join('?' * len(chunk)), chunk)
+        for hash, fingerprint, offset in rows:
+            for queryoffset in offsets[hash]:
+                votes[(fingerprint, offset - queryoffset)] += 1
+
+    if not votes:
+        return None
+    (fingerprint, _), count = votes.most_common(1)[0]
+    if count < FINGERPRINT_MATCHES:
+        return None
+    audiobase, splitbase = db.execute('SELECT audio, segment FROM fingerprints WHERE id = ?',
+                                      (fingerprint,)).fetchone()
+    return audiobase, splitbase, count
+
+
+def get_ad_responses(args):
+    # (audio, segment) of every YES response decided by the llm, a keyword
+    # or a toggle
+    if args.store:
+        rows = get_store(args).execute(
+            'SELECT audio, segment, response FROM segments WHERE response IS NOT NULL').fetchall()
+    else:
+        rows = [(path.stem.rsplit('_silence_', 1)[0], path.stem, path.read_text())
+                for path in sorted(Path("%s/%s" % (args.dir, LLMDIR)).glob('*_silence_*.json'))]
+
+    responses = []
+    for audiobase, splitbase, response in rows:
+        data = json.loads(response)
+        if data['llm'] in ('cascade', 'fingerprint', 'nonspeech') and not data.get('toggled'):
+            continue
+        if data['response'].casefold().startswith('YES'.casefold()):
+            responses.append((audiobase, splitbase))
+    return responses
+
+
+def get_indexed_samples(args, audiobase, splitbase, audios):
+    # mp3splt segments have their own file and native segments are cut from
+    # the audio file named in the stats of the run
+    for path in Path("%s/%s" % (args.dir, SPLITDIR)).glob('%s.*' % glob.escape(splitbase)):
+        return load_audio(str(path))
+
+    statspath = Path("%s/%s_stats.json" % (args.dir, audiobase))
+    if not statspath.is_file():
+        return None
+    stats = json.loads(statspath.read_text())
+    for segment in stats.get('segments', []):
+        if segment['name'] == splitbase and segment['start'] is not None and Path(stats['audiofile']).is_file():
+            if stats['audiofile'] not in audios:
+                audios[stats['audiofile']] = load_audio(stats['audiofile'])
+            audio = audios[stats['audiofile']]
+            return audio[int(segment['start'] * SAMPLE_RATE):int(segment['end'] * SAMPLE_RATE)]
+    return None
+
+
+def index_fingerprints(args):
+    responses = get_ad_responses(args)
+    indexed = 0
+    audios = {}
+    for audiobase, splitbase in responses:
+        samples = get_indexed_samples(args, audiobase, splitbase, audios)
+        if samples is None:
+            if args.verbose:
+                print('No audio for "%s". Skipping.' % splitbase)
+            continue
+        with timed('fingerprint', segment=splitbase):
+            add_fingerprint(args, audiobase, splitbase, samples)
+        indexed += 1
+
+    print('Indexed %d of %d ad responses in "%s"' %
+          (indexed, len(responses), get_fingerprint_path(args)))
+
+
+def label_fingerprint(args, audiobase, segment, audio=None):
+    if get_response(args, audiobase, segment['name']) is not None:
+        return False
+
+    with timed('fingerprint', segment=segment['name']):
+        match = match_fingerprint(args, get_segment_samples(segment, audio))
+    if match is None:
+        return False
+
+    print('Matched fingerprint of "%s" in "%s". Setting response to YES.' %
+          (match[1], segment['name']))
+    put_text(args, audiobase, segment['name'], '')
+    put_response(args, audiobase, segment['name'], {'llm': 'fingerprint', 'match': '%s/%s' % match[:2],
+                                                    'score': match[2], 'response': 'YES'})
+    count_metric('fingerprint_hits')
+    return True
+
+
+# Speech pauses between syllables so many of its short frames are much
+# quieter than the frames around them while music beds and jingles are steady
+SPEECH_FRAME_SECONDS = 0.02
+SPEECH_WINDOW_SECONDS = 1.0
+SPEECH_LOW_ENERGY = 0.5
+SPEECH_MIN_LOW_RATIO = 0.2
+SPEECH_SILENCE_DB = -50
+
+
+def is_speech(samples):
+    framelen = int(SPEECH_FRAME_SECONDS * SAMPLE_RATE)
+    window = int(SPEECH_WINDOW_SECONDS / SPEECH_FRAME_SECONDS)
+    nframes = len(samples) // framelen
+    # Too short to tell so whisper decides
+    if nframes < window:
+        return True
+
+    frames = samples[:nframes * framelen].reshape(nframes, framelen)
+    power = np.mean(np.square(frames, dtype=np.float64), axis=1)
+    if 10 * np.log10(max(np.mean(power), 1e-20)) < SPEECH_SILENCE_DB:
+        return False
+
+    rms = np.sqrt(power)
+    local = np.convolve(rms, np.ones(window) / window, 'same')
+    return np.mean(rms < SPEECH_LOW_ENERGY * local) >= SPEECH_MIN_LOW_RATIO
+
+
+def label_nonspeech(args, audiobase, segment, audio=None):
+    if get_response(args, audiobase, segment['name']) is not None:
+        return False
+
+    with timed('speech', segment=segment['name']):
+        speech = is_speech(get_segment_samples(segment, audio))
+    if speech:
+        return False
+
+    print('Segment "%s" is not speech. Skipping transcription.' %
+          segment['name'])
+    put_text(args, audiobase, segment['name'], '')
+    put_response(args, audiobase, segment['name'], {'llm': 'nonspeech',
+                                                    'response': 'YES' if args.nonspeech == 'ad' else 'NO'})
+    count_metric('nonspeech_skips')
+    return True
+
+
+def get_nonspeech_responses(args, audiobase, segments, responses):
+    def is_nonspeech(data):
+        return data is not None and data['llm'] == 'nonspeech' and not data.get('toggled')
+
+    # Untoggled non-speech segments follow the current policy and a
+    # neighbour is the speech before them or, at the start, after them
+    for i, data in enumerate(responses):
+        if not is_nonspeech(data):
+            continue
+        response = 'YES' if args.nonspeech == 'ad' else 'NO'
+        if args.nonspeech == 'neighbour':
+            neighbours = [other for other in responses[i::-1] + responses[i + 1:]
+                          if other is not None and not is_nonspeech(other)]
+            if neighbours:
+                response = 'YES' if neighbours[0]['response'].casefold().startswith(
+                    'YES'.casefold()) else 'NO'
+        if response != data['response']:
+            data['response'] = response
+            put_response(args, audiobase, segments[i]['name'], data)
+    return responses
+
+
+# Audio seconds and wall seconds spent in whisper
+WHISPER_STATS = {'audio': 0.0, 'seconds': 0.0}
+
+
+def transcribe(args, audiobase, segment, audio=None, offset=0.0):
+    if segment['path'] is None:
+        # Native segments are transcribed straight from the decoded samples
+        # which start at offset seconds
+        name = '"%s" %.1f-%.1f' % (segment['name'],
+                                    segment['start'], segment['end'])
+        source = audio[int((segment['start'] - offset) * SAMPLE_RATE):int((segment['end'] - offset) * SAMPLE_RATE)]
+    else:
+        name = '"%s"' % segment['path'].name
+        source = str(segment['path'])
+
+    key = None
+    if args.cache:
+        if segment['path'] is not None:
+            source = load_audio(source)
+        key = get_audio_key(args, source)
+        text = cache_get(args, WHISPDIR, key)
+        if text is not None:
+            print('Using text from cache for %s' % name)
+            put_text(args, audiobase, segment['name'], text)
+            return
+
+    print('Generating text from %s...' % name)
+    model = get_model(args, 'whisper', args.whisper)
+    start = time.perf_counter()
+    with timed('transcribe', segment=segment['name']):
+        result = model.transcribe(
+            source, language=args.lang, fp16=False, verbose=args.verbose)
+    WHISPER_STATS['seconds'] += time.perf_counter() - start
+    WHISPER_STATS['audio'] += len(source) / SAMPLE_RATE if not isinstance(
+        source, str) else get_duration(source)
+    put_text(args, audiobase, segment['name'], result["text"])
+    if key:
+        cache_put(args, WHISPDIR, key, result["text"])
+
+
+def transcribe_batch(args, audiobase, segments, audio=None):
+    import torch
+    import whisper
+
+    batch = []
+    for segment in segments:
+        source = get_segment_samples(segment, audio)
+
+        # Segments longer than one 30 second window need the sliding
+        # transcription of a single call
+        if len(source) > whisper.audio.N_SAMPLES:
+            transcribe(args, audiobase, segment, audio)
+            continue
+
+        key = None
+        if args.cache:
+            key = get_audio_key(args, source)
+            text = cache_get(args, WHISPDIR, key)
+            if text is not None:
+                print('Using text from cache for "%s"' % segment['name'])
+                put_text(args, audiobase, segment['name'], text)
+                continue
+        batch.append((segment, source, key))
+
+    if not batch:
+        return
+
+    print('Generating text from %s...' %
+          ', '.join('"%s"' % segment['name'] for segment, source, key in batch))
+    model = get_model(args, 'whisper', args.whisper)
+
+    # Each segment is padded to a 30 second log-mel window and all windows
+    # go through the encoder and decoder as one batch
+    start = time.perf_counter()
+    with timed('transcribe', segments=[segment['name'] for segment, source, key in batch]):
+        mels = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(source), model.dims.n_mels)
+                            for segment, source, key in batch]).to(model.device)
+        results = whisper.decode(model, mels, whisper.DecodingOptions(
+            language=args.lang, fp16=False, without_timestamps=True))
+    WHISPER_STATS['seconds'] += time.perf_counter() - start
+    WHISPER_STATS['audio'] += sum(len(source)
+                                  for segment, source, key in batch) / SAMPLE_RATE
+
+    for (segment, source, key), result in zip(batch, results):
+        put_text(args, audiobase, segment['name'], result.text)
+        if key:
+            cache_put(args, WHISPDIR, key, result.text)
+
+
+def get_whisper_stats():
+    if WHISPER_STATS['seconds'] <= 0:
+        return ''
+    return 'Whisper transcribed %.1f seconds of audio in %.1f seconds (%.1f audio seconds per second)\n' % (
+        WHISPER_STATS['audio'], WHISPER_STATS['seconds'], WHISPER_STATS['audio'] / WHISPER_STATS['seconds'])
+
+
+def transcribe_episode(args, audiofile, audio, segments):
+    audiobase = Path(audiofile).stem
+    missing = [segment['name'] for segment in segments
+               if get_text(args, audiobase, segment['name']) is None]
+    if not missing:
+        return
+
+    # Word timestamps of the whole audio are kept so retried segments do not
+    # need another transcription
+    jsonpath = Path("%s/%s/%s.json" % (args.dir, WHISPDIR, audiobase))
+    data = None
+    if jsonpath.is_file():
+        data = json.loads(jsonpath.read_text())
+        if data['whisper'] != args.whisper or data['lang'] != args.lang:
+            data = None
+
+    key = None
+    if data is None and args.cache:
+        key = get_audio_key(args, audio)
+        text = cache_get(args, EPISODEDIR, key)
+        if text is not None:
+            print('Using text from cache for "%s"' % Path(audiofile).name)
+            data = json.loads(text)
+            jsonpath.write_text(text)
+
+    if data is None:
+        print('Generating text from "%s"...' % Path(audiofile).name)
+        model = get_model(args, 'whisper', args.whisper)
+        with timed('transcribe', audiofile=audiofile):
+            result = model.transcribe(
+                audio, language=args.lang, fp16=False, verbose=args.verbose, word_timestamps=True)
+        words = []
+        for segment in result['segments']:
+            for word in segment.get('words') or [{'word': segment['text'], 'start': segment['start'], 'end': segment['end']}]:
+                words.append(
+                    {'word': word['word'], 'start': word['start'], 'end': word['end']})
+        data = {'whisper': args.whisper, 'lang': args.lang, 'words': words}
+        jsonpath.write_text(json.dumps(data, indent=2))
+        if key:
+            cache_put(args, EPISODEDIR, key, json.dumps(data, indent=2))
+
+    # A word belongs to the last segment starting before its midpoint
+    starts = [segment['start'] for segment in segments]
+    texts = [''] * len(segments)
+    for word in data['words']:
+        middle = (word['start'] + word['end']) / 2
+        index = max(bisect.bisect_right(starts, middle) - 1, 0)
+        texts[index] += word['word']
+
+    for segment, text in zip(segments, texts):
+        if segment['name'] in missing:
+            put_text(args, audiobase, segment['name'], text)
+
+
+def transcribe_stage(args, audiobase, segments, transcribed, audio=None):
+    try:
+        for i in range(0, len(segments), args.whisper_batch):
+            batch = segments[i:i + args.whisper_batch]
+
+            # Generate text from audio
+            missing = [segment for segment in batch
+                       if get_text(args, audiobase, segment['name']) is None]
+            count_metric('whisper_hits', len(batch) - len(missing))
+            if args.nonspeech:
+                missing = [segment for segment in missing
+                           if not label_nonspeech(args, audiobase, segment, audio)]
+            if args.fingerprint:
+                missing = [segment for segment in missing
+                           if not label_fingerprint(args, audiobase, segment, audio)]
+            if len(missing) > 1:
+                transcribe_batch(args, audiobase, missing, audio)
+            elif missing:
+                transcribe(args, audiobase, missing[0], audio)
+
+            for segment in batch:
+                transcribed.put(segment)
+    except Exception as e:
+        transcribed.put(e)
+    transcribed.put(None)
+
+
+INSTRUCTION = 'You are an advertising agency.'
+
+
+def get_prompt(text):
+    return 'Answer with YES or NO. Is the following text an advertisement: %s' % text
+
+
+def get_batch_prompt(texts):
+    prompt = 'Answer with YES or NO for each numbered text, one answer per line in the format "1: YES". Is each of the following texts an advertisement?\n'
+    for i, text in enumerate(texts, start=1):
+        prompt += '\n%d: %s\n' % (i, text.strip())
+    return prompt
+
+
+def parse_batch_response(text, count):
+    answers = {}
+    for match in re.finditer(r'^\W*(\d+)\W+(YES|NO)\b', text, re.IGNORECASE | re.MULTILINE):
+        index = int(match.group(1))
+        if 1 <= index <= count and index not in answers:
+            answers[index] = match.group(2).upper()
+    return answers
+
+
+def call_llm(args, llm, prompt, max_tokens=None):
+
+    if llm == args.gemini:
+
+        genai = get_genai()
+
+        # https://ai.google.dev/api/generate-content
+        if args.gemini == 'gemini-pro':
+            model = genai.GenerativeModel(args.gemini)
+        else:
+            model = genai.GenerativeModel(
+                args.gemini, system_instruction=INSTRUCTION)
+
+        generation_config = get_generation_config(max_tokens or 4)
+
+        try:
+            response = gemini_generate(
+                args, args.gemini, model,
+                [prompt],
+                safety_settings=get_safety_settings(),
+                generation_config=generation_config)
+            return response.text
+
+        except Exception as e:
+            print(e, file=sys.stderr)
+            exit(1)
+
+    # https://docs.gpt4all.io/gpt4all_python/ref.html
+    model = get_model(args, 'gpt4all', args.gpt4all)
+    # A new chat session resets the history for each segment
+    with model.chat_session(system_prompt=INSTRUCTION):
+        out = model.generate(prompt, max_tokens=max(1024, max_tokens or 0))
+    # Roughly 4 characters per token
+    count_metric('llm_tokens', (len(prompt) + len(out)) // 4)
+    return out
+
+
+def classify(args, llm, audiobase, splitbases):
+    backend = 'gemini' if llm == args.gemini else 'gpt4all'
+
+    # Send several transcripts in one request and fall back to single
+    # prompts for any segment without a parsable answer
+    if len(splitbases) > 1:
+        print('Calling %s using %s...' %
+              (backend, ', '.join('"%s.txt"' % splitbase for splitbase in splitbases)))
+        texts = [get_text(args, audiobase, splitbase)
+                 for splitbase in splitbases]
+        with timed('classify', llm=llm, segments=splitbases):
+            out = call_llm(args, llm, get_batch_prompt(texts),
+                           max_tokens=8 * len(splitbases))
+        answers = parse_batch_response(out, len(splitbases))
+
+        unparsed = []
+        for index, splitbase in enumerate(splitbases, start=1):
+            if index in answers:
+                write_response(args, audiobase, splitbase,
+                               {'llm': '%s' % llm, 'response': '%s' % answers[index], 'batch': len(splitbases)})
+                print('Response for "%s.txt" = %s' %
+                      (splitbase, answers[index]))
+            else:
+                print('Could not parse response for "%s.txt". Retrying with a single prompt.' %
+                      splitbase)
+                unparsed.append(splitbase)
+        splitbases = unparsed
+
+    for splitbase in splitbases:
+        print('Calling %s using "%s.txt"...' % (backend, splitbase))
+        with timed('classify', llm=llm, segment=splitbase):
+            out = call_llm(args, llm, get_prompt(
+                get_text(args, audiobase, splitbase)))
+        write_response(args, audiobase, splitbase,
+                       {'llm': '%s' % llm, 'response': '%s' % out})
+        print('Response = %s' % out)
+
+
+# A weight is a plain number after the last comma. Digits grouped by a comma
+# like "1,000" stay part of the keyword (give those a weight as "1,000,2").
+KEYWORD_WEIGHT = re.compile(r'^(.*\S)\s*,\s*(\d+(?:\.\d*)?|\.\d+)$')
+KEYWORD_GROUPING = re.compile(r'\d,\d{3}$')
+
+
+def load_keywords(path):
+    # Lines are a keyword or phrase with an optional ",weight" (default 1.0)
+    weights = {}
+    with open(path, 'r') as f:
+        for line in f:
+            keyword, weight = line.strip().lower(), 1.0
+            match = KEYWORD_WEIGHT.match(keyword)
+            if match and not KEYWORD_GROUPING.search(keyword):
+                keyword, weight = match.group(1), float(match.group(2))
+            if keyword:
+                weights[keyword] = weight
+
+    if not weights:
+        return None
+
+    # One alternation of escaped terms, longest first so phrases win over
+    # their prefixes, is compiled once and scans each text in a single pass
+    alternation = '|'.join(re.escape(keyword)
+                           for keyword in sorted(weights, key=len, reverse=True))
+    return {'pattern': re.compile(r'(?<!\w)(?:%s)(?!\w)' % alternation), 'weights': weights}
+
+
+def match_keywords(keywords, text):
+    matches = []
+    for match in keywords['pattern'].finditer(text.lower()):
+        if match.group() not in matches:
+            matches.append(match.group())
+    return matches, sum(keywords['weights'][keyword] for keyword in matches)
+
+
+def get_tokens(text):
+    return re.findall(r"[a-z0-9']+", text.lower())
+
+
+def get_labeled_texts(args):
+    # Untoggled cascade and fingerprint responses are not llm labels
+    def is_label(data):
+        return data['llm'] not in ('cascade', 'fingerprint', 'nonspeech') or data.get('toggled')
+
+    if args.store:
+        rows = get_store(args).execute(
+            'SELECT text, response FROM segments WHERE text IS NOT NULL AND response IS NOT NULL').fetchall()
+        responses = [(text, json.loads(response)) for text, response in rows]
+    else:
+        responses = []
+        for jsonpath in sorted(Path("%s/%s" % (args.dir, LLMDIR)).glob('*.json')):
+            txtpath = Path("%s/%s/%s.txt" %
+                           (args.dir, WHISPDIR, jsonpath.stem))
+            if txtpath.is_file():
+                responses.append(
+                    (txtpath.read_text(), json.loads(jsonpath.read_text())))
+
+    return [(text, 'YES' if data['response'].casefold().startswith('YES'.casefold()) else 'NO')
+            for text, data in responses if is_label(data)]
+
+
+def get_cascade_probability(model, tokens, held_out=None):
+    # Multinomial naive Bayes with add-one smoothing. A held out (tokens,
+    # label) example is subtracted from the counts for leave-one-out scores.
+    logs = {}
+    for label in ('YES', 'NO'):
+        own = held_out is not None and held_out[1] == label
+        removed = collections.Counter(held_out[0] if own else [])
+        docs = model['docs'][label] - (1 if own else 0)
+        if docs <= 0:
+            return 0.0 if label == 'YES' else 1.0
+        words = model['words'][label]
+        total = model['totals'][label] - sum(removed.values())
+        logs[label] = math.log(docs) + sum(math.log((words.get(token, 0) - removed[token] + 1) / (total + model['vocab']))
+                                           for token in tokens)
+
+    diff = logs['YES'] - logs['NO']
+    if diff >= 0:
+        return 1 / (1 + math.exp(-diff))
+    return math.exp(diff) / (1 + math.exp(diff))
+
+
+def load_cascade(args):
+    path = Path("%s/%s" % (args.dir, CASCADEFILE))
+    if not path.is_file():
+        print('"%s" does not exist. Run --train first.' %
+              path, file=sys.stderr)
+        exit(1)
+    return json.loads(path.read_text())
+
+
+def train_cascade(args):
+    examples = [(get_tokens(text), label)
+                for text, label in get_labeled_texts(args)]
+
+    model = {'docs': {'YES': 0, 'NO': 0}, 'words': {'YES': {}, 'NO': {}},
+             'totals': {'YES': 0, 'NO': 0}}
+    for tokens, label in examples:
+        model['docs'][label] += 1
+        model['totals'][label] += len(tokens)
+        words = model['words'][label]
+        for token in tokens:
+            words[token] = words.get(token, 0) + 1
+    model['vocab'] = len(set(model['words']['YES']) |
+                         set(model['words']['NO']))
+
+    if not model['docs']['YES'] or not model['docs']['NO']:
+        print('Need YES and NO responses in "%s" to train the cascade.' %
+              args.dir, file=sys.stderr)
+        exit(1)
+
+    path = Path("%s/%s" % (args.dir, CASCADEFILE))
+    path.write_text(json.dumps(model))
+    print('Trained cascade on %d responses (%d YES, %d NO) in "%s"' %
+          (len(examples), model['docs']['YES'], model['docs']['NO'], path))
+
+    # Each response is scored by a model trained on all the others
+    confidence = args.cascade or CASCADE_CONFIDENCE
+    avoided = wrong = 0
+    for tokens, label in examples:
+        probability = get_cascade_probability(
+            model, tokens, (tokens, label))
+        if max(probability, 1 - probability) >= confidence:
+            avoided += 1
+            if ('YES' if probability >= 0.5 else 'NO') != label:
+                wrong += 1
+    print('Cascade at %.2f confidence would have avoided %d of %d llm calls (%d disagreeing with the llm)' %
+          (confidence, avoided, len(examples), wrong))
+
+
+def check_keywords(args, audiobase, splitbase, text, keywords):
+    matches, score = match_keywords(keywords, text)
+    if matches and score >= args.keyword_score:
+        keyword = ', '.join(matches)
+        print('Identified ad keyword "%s" in "%s.txt". Setting response to YES.' %
+              (keyword, splitbase))
+        data = {'llm': 'keyword', 'keyword': '%s' %
+                keyword, 'score': score, 'response': 'YES'}
+        put_response(args, audiobase, splitbase, data)
+        count_metric('keyword_hits')
+        return data
+    if matches and args.verbose:
+        print('Keyword score %g of "%s" in "%s.txt" is below %g' %
+              (score, ', '.join(matches), splitbase, args.keyword_score))
+    return None
+
+
+def resolve_segment(args, llm, audiobase, splitbase, text, keywords=None, cascade=None):
+    # Cheaper ways to a response are tried before the llm
+    data = None
+
+    # Check for ad keywords
+    if keywords:
+        data = check_keywords(args, audiobase, splitbase, text, keywords)
+
+    # Use a response to the same text from any earlier run
+    if data is None:
+        cached = cache_get(args, LLMDIR, get_text_key(llm, text))
+        if cached is not None:
+            print('Using response from cache for "%s.txt"' %
+                  splitbase)
+            data = json.loads(cached)
+            put_response(args, audiobase, splitbase, data)
+
+    # Only segments the cascade is unsure of go to the llm
+    if data is None and cascade:
+        probability = get_cascade_probability(
+            cascade, get_tokens(text))
+        if max(probability, 1 - probability) >= args.cascade:
+            response = 'YES' if probability >= 0.5 else 'NO'
+            print('Cascade response for "%s.txt" = %s (%.2f)' %
+                  (splitbase, response, probability))
+            data = {'llm': 'cascade', 'probability': probability,
+                    'response': response}
+            put_response(args, audiobase, splitbase, data)
+            count_metric('cascade_hits')
+
+    return data
+
+
+def process_audiofile(args, audiofile, llm, keywords=None, cascade=None):
+
+    splitdir = args.dir + '/' + SPLITDIR
+
+    ads = 0
+    avoided = 0
+    skipped = 0
+    skippedseconds = 0.0
+    concatstr = ''
+    adconcatstr = ''
+    tracks = []
+    segmentstats = []
+    audiobase = Path(audiofile).stem
+    audioext = Path(audiofile).suffix
+    adslog = Path("%s/%s_ads.log" % (args.dir, audiobase)).open("a")
+    adslog.truncate(0)
+    noadslog = Path("%s/%s_noads.log" % (args.dir, audiobase)).open("a")
+    noadslog.truncate(0)
+
+    if args.gemini_audio:
+        return gemini_audio(args, audiofile, adslog, noadslog)
+
+    audio = None
+    with timed('split', audiofile=audiofile, splitter=args.splitter):
+        if args.splitter == 'native':
+            try:
+                audio = load_audio(audiofile)
+            except Exception:
+                print('"%s" is not a valid audio file.' %
+                      audiofile, file=sys.stderr)
+                exit(1)
+            segments = get_native_segments(
+                args, audiofile, get_levels(audio), len(audio) / SAMPLE_RATE)
+        else:
+            command = get_split_command(
+                args, SPLITDIR, Path(audiofile).resolve())
+            process = subprocess.Popen(shlex.split(command), cwd=args.dir)
+            returncode = process.wait()
+            if returncode != 0:
+                print('"%s" is not a valid audio file.' %
+                      audiofile, file=sys.stderr)
+                exit(1)
+
+            pattern = '%s*%s' % (glob.escape(audiobase), audioext)
+            segments = [{'name': path.stem, 'path': path, 'start': None, 'end': None}
+                        for path in sorted(Path(splitdir).glob(pattern))]
+
+    # Count number of split segments
+    count = len(segments)
+    outlog = 'audio="%s" min=%s shots=%s th=%s splits=%d whisper="%s" llm="%s"' % (
+        audiofile, args.min, args.shots, args.th, count, args.whisper, llm)
+    print(outlog)
+    if count <= 0:
+        print('No split files created. %s\n' % SPLITCHG, file=sys.stderr)
+        return None
+
+    noadslog.write(outlog + '\n\n')
+    noadslog.flush()
+
+    adslog.write(outlog + '\n\n')
+    adslog.flush()
+
+    put_run(args, audiobase, {'min': args.min, 'shots': args.shots, 'th': args.th, 'splitter': args.splitter,
+                              'splits': count, 'whisper': args.whisper, 'llm': llm})
+
+    if args.episode:
+        transcribe_episode(args, audiofile, audio, segments)
+
+    # Transcribe in a background stage so whisper works on the next
+    # segment while the current one is being classified
+    transcribed = queue.Queue(maxsize=QUEUE_SIZE)
+    threading.Thread(target=transcribe_stage, args=(
+        args, audiobase, segments, transcribed, audio), daemon=True).start()
+
+    # Iterate over transcribed split segments
+    pending = []
+    while True:
+        segment = transcribed.get()
+        if segment is None:
+            break
+        if isinstance(segment, Exception):
+            print(segment, file=sys.stderr)
+            exit(1)
+
+        print(SEP)
+
+        splitbase = segment['name']
+
+        text = get_text(args, audiobase, splitbase)
+        if text is not None:
+            data = get_response(args, audiobase, splitbase)
+            if data is not None:
+                count_metric('llm_hits')
+
+                # Keywords apply to earlier responses too unless they were toggled
+                if keywords and not data.get('toggled'):
+                    data = check_keywords(
+                        args, audiobase, splitbase, text, keywords) or data
+
+            if data is None:
+                data = resolve_segment(
+                    args, llm, audiobase, splitbase, text, keywords, cascade)
+                if data is not None and data['llm'] == 'cascade':
+                    avoided += 1
+
+            # Generate response json from text
+            if data is None:
+                pending.append(splitbase)
+                if len(pending) >= args.batch:
+                    classify(args, llm, audiobase, pending)
+                    pending = []
+
+            else:
+                print('Using response from "%s.json"' %
+                      splitbase)
+                print('Response = %s' % data['response'])
+
+    if pending:
+        classify(args, llm, audiobase, pending)
+
+    # Parse json for text = YES or NO
+    responses = [get_response(args, audiobase, segment['name'])
+                 for segment in segments]
+    if args.nonspeech:
+        responses = get_nonspeech_responses(
+            args, audiobase, segments, responses)
+    for segment, data in zip(segments, responses):
+        if data is not None:
+            txtfilelog = "%s %s.txt %s\n%s\n\n" % (
+                SEP, segment['name'], SEP, get_text(args, audiobase, segment['name']))
+            response = data['response']
+            if response.casefold().startswith('YES'.casefold()):
+                ads = ads+1
+                adslog.write(txtfilelog)
+                adslog.flush()
+                adconcatstr += get_concat_entry(audiofile, segment)
+                tracks.append((segment, 'Ad'))
+                if args.fingerprint and data['llm'] not in ('fingerprint', 'nonspeech'):
+                    with timed('fingerprint', segment=segment['name']):
+                        add_fingerprint(args, audiobase, segment['name'],
+                                        get_segment_samples(segment, audio))
+            else:
+                noadslog.write(txtfilelog)
+                noadslog.flush()
+                concatstr += get_concat_entry(audiofile, segment)
+                tracks.append((segment, 'Content'))
+
+            if segment['path'] is None:
+                duration = segment['end'] - segment['start']
+            else:
+                duration = get_duration(segment['path'])
+            segmentstats.append({'name': segment['name'], 'start': segment['start'], 'end': segment['end'],
+                                 'duration': duration, 'response': 'YES' if tracks[-1][1] == 'Ad' else 'NO',
+                                 'llm': data.get('llm'), 'confidence': get_confidence(data), 'score': get_score(data)})
+            if data['llm'] == 'nonspeech':
+                skipped += 1
+                skippedseconds += duration
+
+    if args.splitter == 'native':
+        # Ranges are known so the output is cut from the original audio
+        with timed('render', audiofile=audiofile):
+            noadsaudio = render_ranges(args, audiofile,
+                                       [(segment['start'], segment['end'])
+                                        for segment, title in tracks if title == 'Content'],
+                                       [(segment['start'], segment['end']) for segment, title in tracks if title == 'Ad'])
+        if args.cue:
+            write_cue(args, audiofile, [(segment['start'], '%s %s' % (title, segment['name']))
+                                        for segment, title in tracks])
+
+        # Durations come from the decoded audio and segment times
+        audiodt = datetime.timedelta(
+            milliseconds=int(len(audio) * 1000 / SAMPLE_RATE))
+        noadsdt = datetime.timedelta(milliseconds=int(sum(segment['end'] - segment['start']
+                                                          for segment, title in tracks if title == 'Content') * 1000))
+    else:
+        # mp3splt segments are joined from their files
+        with timed('render', audiofile=audiofile):
+            noadsaudio = get_noads_file(audiofile, args.dir, concatstr)
+            if args.ads_file:
+                get_noads_file(audiofile, args.dir, adconcatstr, 'ads')
+        if args.cue:
+            print('A cue file needs segment times from -S native.',
+                  file=sys.stderr)
+        with timed('stats', audiofile=audiofile):
+            audiodt, noadsdt = get_durations(audiofile, noadsaudio)
+
+    with timed('stats', audiofile=audiofile):
+        adsout = format_ads_stats(ads, audiodt, noadsdt)
+        stats = get_stats(audiofile, ads, audiodt, noadsdt, segmentstats)
+        if args.nonspeech:
+            adsout += 'Non-speech segments skipped = %d (%.1f seconds not transcribed)\n' % (
+                skipped, skippedseconds)
+            stats['nonspeech'] = {'policy': args.nonspeech,
+                                  'segments': skipped, 'seconds': skippedseconds}
+        write_stats(args, audiobase, stats)
+
+    adslog.write(adsout)
+    print(adsout)
+    if cascade:
+        print('Cascade avoided llm calls = %d' % avoided)
+
+    noadsout = SEP + '\n'
+    noadsout += 'Total no ads = %d\n' % (count - ads)
+    noadslog.write(noadsout)
+
+    adslog.close()
+    noadslog.close()
+
+    evict_cache(args)
+
+    return {'audiofile': audiofile, 'ads': ads, 'audio': audiodt, 'noads': noadsdt}
+
+
+def process_follow(args, audiofile, llm, keywords=None, cascade=None):
+    ads = 0
+    count = 0
+    duration = 0
+    written = 0
+    head = b''
+    if audiofile == '-':
+        head = sys.stdin.buffer.read(STREAM_HEAD)
+        audiobase, audioext = 'stdin', get_stream_ext(head)
+    else:
+        audiobase, audioext = Path(audiofile).stem, Path(audiofile).suffix
+    adslog = Path("%s/%s_ads.log" % (args.dir, audiobase)).open("a")
+    adslog.truncate(0)
+    noadslog = Path("%s/%s_noads.log" % (args.dir, audiobase)).open("a")
+    noadslog.truncate(0)
+
+    # Segments close at different points in every run and every stdin is
+    # named stdin so no progress of an earlier run is reused (--cache still
+    # reuses text and responses by content)
+    purge_segments(args, audiobase)
+
+    outlog = 'audio="%s" min=%s shots=%s th=%s follow=%s whisper="%s" llm="%s"' % (
+        audiofile, args.min, args.shots, args.th, args.follow, args.whisper, llm)
+    print(outlog)
+    noadslog.write(outlog + '\n\n')
+    noadslog.flush()
+    adslog.write(outlog + '\n\n')
+    adslog.flush()
+
+    # Non ad audio is appended to the encoder as each segment is decided,
+    # from source frames so the output keeps the rate and channels
+    noadsaudio = str(Path("%s/%s_noads%s" %
+                          (args.dir, audiobase, audioext)).resolve())
+    encoder = None
+    frames = None
+    framesoffset = 0
+    rate = SAMPLE_RATE
+
+    def chunks():
+        nonlocal duration, encoder, frames, rate
+        for chunk, chunkframes, rate in read_stream(args, audiofile, head):
+            if encoder is None:
+                encoder = subprocess.Popen(shlex.split(get_encode_command(
+                    noadsaudio, rate, chunkframes.shape[1])), stdin=subprocess.PIPE)
+                frames = chunkframes
+            else:
+                frames = np.concatenate((frames, chunkframes))
+            duration += len(chunk)
+            yield chunk
+
+    for segment, samples in get_stream_segments(args, audiobase, chunks()):
+        count += 1
+        print(SEP)
+
+        # Frames before the end of a segment are never needed again
+        start = int(round(segment['start'] * rate)) - framesoffset
+        end = int(round(segment['end'] * rate)) - framesoffset
+        segmentframes = frames[start:end]
+        frames = frames[end:]
+        framesoffset += end
+
+        splitbase = segment['name']
+        if get_text(args, audiobase, splitbase) is None:
+            transcribe(args, audiobase, segment, samples, segment['start'])
+        text = get_text(args, audiobase, splitbase)
+
+        data = get_response(args, audiobase, splitbase)
+        if data is None:
+            data = resolve_segment(
+                args, llm, audiobase, splitbase, text, keywords, cascade)
+        if data is None:
+            classify(args, llm, audiobase, [splitbase])
+            data = get_response(args, audiobase, splitbase)
+        else:
+            print('Using response from "%s.json"' % splitbase)
+            print('Response = %s' % data['response'])
+
+        txtfilelog = "%s %s.txt %s\n%s\n\n" % (SEP, splitbase, SEP, text)
+        if data['response'].casefold().startswith('YES'.casefold()):
+            ads = ads+1
+            adslog.write(txtfilelog)
+            adslog.flush()
+        else:
+            noadslog.write(txtfilelog)
+            noadslog.flush()
+            encoder.stdin.write(segmentframes.tobytes())
+            encoder.stdin.flush()
+            written += len(samples)
+
+    if encoder is not None:
+        encoder.stdin.close()
+        encoder.wait()
+
+    if count <= 0:
+        print('No split files created. %s\n' % SPLITCHG, file=sys.stderr)
+        return None
+
+    audiodt = datetime.timedelta(
+        milliseconds=int(duration * 1000 / SAMPLE_RATE))
+    noadsdt = datetime.timedelta(
+        milliseconds=int(written * 1000 / SAMPLE_RATE))
+    adsout = format_ads_stats(ads, audiodt, noadsdt)
+    write_stats(args, audiobase, get_stats(audiofile, ads, audiodt, noadsdt))
+
+    adslog.write(adsout)
+    print(adsout)
+
+    noadsout = SEP + '\n'
+    noadsout += 'Total no ads = %d\n' % (count - ads)
+    noadslog.write(noadsout)
+
+    adslog.close()
+    noadslog.close()
+
+    evict_cache(args)
+
+    return {'audiofile': audiofile, 'ads': ads, 'audio': audiodt, 'noads': noadsdt}
+
+
+def process_job(args, audiofile, llm, keywords=None, cascade=None):
+    # Buffer output so files processed in parallel do not interleave
+    out = io.StringIO()
+    code = 0
+    reset_telemetry()
+    # Models stay resident in the worker, only this job's loads and hits count
+    MODEL_STATS.clear()
+    with contextlib.redirect_stdout(out):
+        try:
+            result = process_audiofile(
+                args, audiofile, llm, keywords, cascade)
+        except SystemExit as e:
+            result = None
+            code = e.code
+    return result, out.getvalue(), code, get_telemetry(), copy_model_stats()
+
+
+# --serve listens on the loopback interface only
+SERVE_HOST = '127.0.0.1'
+SUBMIT_POLL = 1.0
+JOBS = {}
+JOBS_LOCK = threading.Lock()
+
+
+def check_args(args):
+    # Checks and setup shared by a CLI run and a --serve job
+    if args.follow is not None:
+        if len(args.audiofiles) != 1:
+            print('Follow mode takes one audio file.', file=sys.stderr)
+            exit(1)
+        if args.follow < 0:
+            print('Follow seconds must not be negative.', file=sys.stderr)
+            exit(1)
 
     # Check if audio exists
     for audiofile in args.audiofiles:
+        if args.follow is not None and audiofile == '-':
+            continue
         if not Path(audiofile).is_file():
             print('"%s" does not exist.' % audiofile, file=sys.stderr)
             exit(1)
@@ -298,24 +2522,289 @@ def main(args=None):
         if not Path(args.keyword_file).is_file():
             print('"%s" does not exist.' % args.keyword_file, file=sys.stderr)
             exit(1)
-        with open(args.keyword_file, 'r') as f:
-            keywords = set(keyword.strip().lower() for keyword in f)
+        keywords = load_keywords(args.keyword_file)
+
+    # Slicing the text needs the time range of each segment
+    if args.episode:
+        args.splitter = 'native'
+
+    if args.migrate:
+        args.store = True
+
+    if args.jobs < 1:
+        print('Jobs must be greater than 0.', file=sys.stderr)
+        exit(1)
+
+    if args.batch < 1:
+        print('Batch size must be greater than 0.', file=sys.stderr)
+        exit(1)
+
+    if args.whisper_batch < 1:
+        print('Whisper batch size must be greater than 0.', file=sys.stderr)
+        exit(1)
+
+    if args.cascade is not None and not 0.5 <= args.cascade <= 1.0:
+        print('Cascade confidence must be between 0.5 and 1.0.', file=sys.stderr)
+        exit(1)
 
     if Path(args.dir).is_dir() is not True:
         Path(args.dir).mkdir(parents=True, exist_ok=True)
 
+    return keywords
+
+
+def prepare_run(args):
+    cascade = None
+    if args.cascade:
+        cascade = load_cascade(args)
+
+    if not args.gemini_audio:
+        for subdir in (SPLITDIR, WHISPDIR, LLMDIR):
+            Path("%s/%s" % (args.dir, subdir)).mkdir(parents=True, exist_ok=True)
+
+    return cascade
+
+
+# Options of a CLI run that a --serve job can not take
+JOB_OPTIONS = {'-c': 'count', '-f': 'follow', '--index': 'index', '-j': 'jobs', '--migrate': 'migrate', '-p': 'purge', '-P': 'purge_all',
+               '-r': 'retry', '--serve': 'serve', '--submit': 'submit', '--sweep': 'sweep', '-t': 'toggle', '--train': 'train'}
+
+
+def get_unsupported_options(args):
+    # Default of -j is 1 and -f 0 follows forever
+    return [option for option, name in JOB_OPTIONS.items()
+            if getattr(args, name) is not None and getattr(args, name) is not False
+            and not (name == 'jobs' and args.jobs == 1)]
+
+
+def run_job(args):
+    global TRACE_EVENTS
+
+    # Spans are only recorded for jobs with --trace unless the server has it
+    tracing = TRACE_EVENTS is None and args.trace
+    if tracing:
+        TRACE_EVENTS = []
+    try:
+        before = get_telemetry()
+        results = process_job_files(args)
+        write_telemetry(args, get_telemetry_since(before))
+    finally:
+        if tracing:
+            TRACE_EVENTS = None
+    return results
+
+
+def process_job_files(args):
+    # A CLI run without the maintenance options
+    keywords = check_args(args)
+    cascade = prepare_run(args)
+    llm = args.gemini or args.gpt4all
+
+    results = [process_audiofile(args, audiofile, llm, keywords, cascade)
+               for audiofile in args.audiofiles]
+    return [{'audiofile': result['audiofile'], 'ads': result['ads'], 'audio': result['audio'].total_seconds(),
+             'noads': result['noads'].total_seconds()} for result in results if result]
+
+
+def work_jobs(jobs):
+    # Jobs run one at a time and share the loaded models
+    while True:
+        job = jobs.get()
+        job['status'] = 'running'
+        out = io.StringIO()
+        code = 0
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            try:
+                job['results'] = run_job(get_args(job['argv']))
+            except SystemExit as e:
+                code = e.code
+            except Exception as e:
+                print(e, file=sys.stderr)
+                code = 1
+        job['output'] = out.getvalue()
+        job['code'] = code
+        job['status'] = 'failed' if code else 'done'
+
+
+def serve(args):
+    GEMINI_KEY = "GEMINI_API_KEY"
+    load_dotenv()
+    if GEMINI_KEY in os.environ:
+        get_genai().configure(api_key=os.environ[GEMINI_KEY])
+
+    # Load the default models before the first job arrives
+    if not args.gemini_audio:
+        get_model(args, 'whisper', args.whisper)
+        if not args.gemini:
+            get_model(args, 'gpt4all', args.gpt4all)
+
+    jobs = queue.Queue()
+    threading.Thread(target=work_jobs, args=(jobs,), daemon=True).start()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def send_json(self, code, data):
+            body = json.dumps(data).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            # GET /metrics returns the counters of all jobs so far
+            if self.path.strip('/') == 'metrics':
+                body = get_metrics().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            # GET /jobs lists all jobs and GET /jobs/<id> returns one
+            parts = self.path.strip('/').split('/')
+            with JOBS_LOCK:
+                if parts == ['jobs']:
+                    self.send_json(200, [{'id': job['id'], 'status': job['status']}
+                                         for job in JOBS.values()])
+                elif len(parts) == 2 and parts[0] == 'jobs' and parts[1] in JOBS:
+                    self.send_json(200, JOBS[parts[1]])
+                else:
+                    self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            # POST /jobs with {"argv": ["audiofile", "-e", "-50", ...]}
+            if self.path.strip('/') != 'jobs':
+                self.send_json(404, {'error': 'not found'})
+                return
+            try:
+                argv = json.loads(self.rfile.read(
+                    int(self.headers.get('Content-Length', 0))))['argv']
+            except (ValueError, KeyError, TypeError):
+                self.send_json(400, {'error': 'expected {"argv": [...]}'})
+                return
+            try:
+                unsupported = get_unsupported_options(get_args(argv))
+            except (SystemExit, TypeError):
+                self.send_json(400, {'error': 'invalid argv %s' % argv})
+                return
+            if unsupported:
+                self.send_json(400, {'error': 'jobs can not take %s' %
+                                     ', '.join(unsupported)})
+                return
+            with JOBS_LOCK:
+                job = {'id': str(len(JOBS) + 1), 'argv': argv, 'status': 'queued',
+                       'results': None, 'output': '', 'code': None}
+                JOBS[job['id']] = job
+            jobs.put(job)
+            self.send_json(202, {'id': job['id'], 'status': job['status']})
+
+        def log_message(self, format, *values):
+            if args.verbose:
+                super().log_message(format, *values)
+
+    server = http.server.ThreadingHTTPServer((SERVE_HOST, args.serve), Handler)
+    print('Serving rmads jobs on http://%s:%d/jobs' %
+          (SERVE_HOST, args.serve), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+# Options with a path that is made absolute for the server by --submit
+SUBMIT_PATHS = ['--cache', '-d', '--dir',
+                '-k', '--keyword-file', '--metrics', '--trace']
+
+
+def submit(args, argv):
+    # Paths are made absolute for the server's working directory
+    options = []
+    skip = False
+    path = False
+    for value in argv:
+        option = value.split('=', 1)[0]
+        if skip:
+            skip = False
+        elif value == '--submit':
+            skip = True
+        elif option == '--submit':
+            pass
+        elif path or value in args.audiofiles:
+            options.append(str(Path(value).resolve()))
+            path = False
+        elif option in SUBMIT_PATHS and '=' in value:
+            options.append('%s=%s' %
+                           (option, Path(value.split('=', 1)[1]).resolve()))
+        else:
+            options.append(value)
+            path = value in SUBMIT_PATHS
+    options += ['-d', str(Path(args.dir).resolve())]
+
+    url = 'http://%s:%d/jobs' % (SERVE_HOST, args.submit)
+    try:
+        request = urllib.request.Request(url, data=json.dumps({'argv': options}).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            job = json.load(response)
+        print('Submitted job %s to %s' % (job['id'], url))
+
+        while job['status'] in ('queued', 'running'):
+            time.sleep(SUBMIT_POLL)
+            with urllib.request.urlopen('%s/%s' % (url, job['id'])) as response:
+                job = json.load(response)
+    except OSError as e:
+        print('Could not submit to %s: %s' % (url, e), file=sys.stderr)
+        exit(1)
+
+    print(job['output'], end='')
+    exit(job['code'])
+
+
+def write_telemetry(args, telemetry=None):
+    if args.trace:
+        write_trace(args.trace, telemetry)
+        print('Wrote trace to "%s"' % args.trace)
+    if args.metrics:
+        Path(args.metrics).write_text(get_metrics(telemetry))
+        print('Wrote metrics to "%s"' % args.metrics)
+
+
+def main(args=None):
+    global TRACE_EVENTS
+
+    args = get_args()
+
+    if args.trace:
+        TRACE_EVENTS = []
+
+    if args.serve is not None:
+        serve(args)
+        write_telemetry(args)
+        return
+
+    if args.submit is not None:
+        submit(args, sys.argv[1:])
+
+    keywords = check_args(args)
+
     splitdir = args.dir + '/' + SPLITDIR
     whispdir = args.dir + '/' + WHISPDIR
     llmdir = args.dir + '/' + LLMDIR
+    profiledir = args.dir + '/' + PROFILEDIR
 
     if args.purge_all and not args.gemini_audio:
         shutil.rmtree(splitdir, ignore_errors=True)
         shutil.rmtree(whispdir, ignore_errors=True)
         shutil.rmtree(llmdir, ignore_errors=True)
+        shutil.rmtree(profiledir, ignore_errors=True)
         if args.verbose:
             print("Removed %s" % splitdir)
             print("Removed %s" % whispdir)
             print("Removed %s" % llmdir)
+            print("Removed %s" % profiledir)
         for path in Path(args.dir).glob('mp3splt.log'):
             path.unlink()
             if args.verbose:
@@ -329,6 +2818,22 @@ def main(args=None):
             path.unlink()
             if args.verbose:
                 print("Removed %s" % path)
+        for path in Path(args.dir).glob('*_ads.*'):
+            path.unlink()
+            if args.verbose:
+                print("Removed %s" % path)
+        for path in Path(args.dir).glob('*_stats.json'):
+            path.unlink()
+            if args.verbose:
+                print("Removed %s" % path)
+        for path in Path(args.dir).glob('*.cue'):
+            path.unlink()
+            if args.verbose:
+                print("Removed %s" % path)
+        for path in [*Path(args.dir).glob('%s*' % STOREDB), *Path(args.dir).glob('%s*' % FINGERPRINTDB)]:
+            path.unlink()
+            if args.verbose:
+                print("Removed %s" % path)
 
         print('Purged all progress files in "%s"' % args.dir)
 
@@ -348,10 +2853,18 @@ def main(args=None):
                 path.unlink()
                 if args.verbose:
                     print("Removed %s" % path)
+            for path in Path(whispdir).glob('%s.json' % audiobase):
+                path.unlink()
+                if args.verbose:
+                    print("Removed %s" % path)
             for path in Path(llmdir).glob('%s*.json' % audiobase):
                 path.unlink()
                 if args.verbose:
                     print("Removed %s" % path)
+            for path in Path(profiledir).glob('%s.npz' % audiobase):
+                path.unlink()
+                if args.verbose:
+                    print("Removed %s" % path)
             for path in Path(args.dir).glob('%s*ads.log' % audiobase):
                 path.unlink()
                 if args.verbose:
@@ -360,9 +2873,46 @@ def main(args=None):
                 path.unlink()
                 if args.verbose:
                     print("Removed %s" % path)
+            for path in Path(args.dir).glob('%s_ads%s' % (audiobase, audioext)):
+                path.unlink()
+                if args.verbose:
+                    print("Removed %s" % path)
+            for path in Path(args.dir).glob('%s_stats.json' % audiobase):
+                path.unlink()
+                if args.verbose:
+                    print("Removed %s" % path)
+            for path in Path(args.dir).glob('%s.cue' % audiobase):
+                path.unlink()
+                if args.verbose:
+                    print("Removed %s" % path)
+            if args.store:
+                purge_store(args, Path(audiofile).stem)
 
             print('Purged "%s" progress files in "%s"' % (audiofile, args.dir))
 
+    # Count from the silence profile without writing any split files
+    if args.sweep or (args.count and args.splitter == 'native'):
+        for audiofile in args.audiofiles:
+            try:
+                levels, duration = get_profile(args, audiofile)
+            except Exception:
+                print('"%s" is not a valid audio file.' %
+                      audiofile, file=sys.stderr)
+                exit(1)
+
+            if args.sweep:
+                print('audio="%s"' % audiofile)
+                for th, min, shots in get_sweep(args):
+                    count = len(get_native_segments(
+                        args, audiofile, levels, duration, th, min, shots))
+                    print('th=%d min=%.2f shots=%d splits=%d' %
+                          (th, min, shots, count))
+            else:
+                print(len(get_native_segments(
+                    args, audiofile, levels, duration)))
+
+        exit(0)
+
     if args.count:
         for audiofile in args.audiofiles:
             with tempfile.TemporaryDirectory() as tempdir:
@@ -383,219 +2933,116 @@ def main(args=None):
 
         exit(0)
 
+    if args.migrate:
+        migrate_store(args)
+        exit(0)
+
     # Retry a specific segment
     if not args.retry == None:
         for retry in args.retry:
             for audiofile in args.audiofiles:
-                txtpath = Path('%s/%s_silence_%s.txt' %
-                               (whispdir, Path(audiofile).stem, retry))
-                txtpath.unlink(missing_ok=True)
-                jsonpath = Path('%s/%s_silence_%s.json' %
-                                (llmdir, Path(audiofile).stem, retry))
-                jsonpath.unlink(missing_ok=True)
+                audiobase = Path(audiofile).stem
+                delete_segment(args, audiobase, '%s_silence_%s' %
+                               (audiobase, retry))
 
     # Toggle a specific segment (change YES to NO or NO to YES)
     if not args.toggle == None:
         for toggle in args.toggle:
             for audiofile in args.audiofiles:
 
-                jsonfile = '%s/%s_silence_%s.json' % (
-                    llmdir, Path(audiofile).stem, toggle)
+                audiobase = Path(audiofile).stem
+                splitbase = '%s_silence_%s' % (audiobase, toggle)
+                data = get_response(args, audiobase, splitbase)
 
-                if not Path(jsonfile).is_file():
-                    print('"%s" does not exist. Can not toggle.' %
-                          jsonfile, file=sys.stderr)
+                if data is None:
+                    print('"%s/%s.json" does not exist. Can not toggle.' %
+                          (llmdir, splitbase), file=sys.stderr)
                     exit(1)
 
-                with open(jsonfile, 'r') as f:
-                    data = json.load(f)
-
                 if data['response'].casefold().startswith('YES'.casefold()):
                     data['response'] = 'NO'
                 else:
                     data['response'] = 'YES'
                 data['toggled'] = True
 
-                with open(jsonfile, 'w') as f:
-                    json.dump(data, f, indent=2)
+                # A segment that is not an ad must not match new segments,
+                # and a wrong match is removed at the ad it matched
+                if data['response'] == 'NO' and get_fingerprint_path(args).is_file():
+                    delete_fingerprint(args, audiobase, splitbase)
+                    if data['llm'] == 'fingerprint':
+                        delete_fingerprint(
+                            args, *data['match'].split('/', 1))
+
+                # Corrections are shared with other runs of the same text
+                if data['llm'] not in ('keyword', 'fingerprint', 'nonspeech') and get_text(args, audiobase, splitbase) is not None:
+                    write_response(args, audiobase, splitbase, data)
+                else:
+                    put_response(args, audiobase, splitbase, data)
+
+    if args.train:
+        train_cascade(args)
+        exit(0)
+
+    if args.index:
+        index_fingerprints(args)
+        exit(0)
 
     llm = args.gpt4all
     if args.gemini or args.gemini_audio:
         GEMINI_KEY = "GEMINI_API_KEY"
         load_dotenv()
         if GEMINI_KEY in os.environ:
-            genai.configure(api_key=os.environ[GEMINI_KEY])
+            get_genai().configure(api_key=os.environ[GEMINI_KEY])
             llm = args.gemini
         else:
             print(
                 '%s not found. You must have a Gemini API key from (https://aistudio.google.com/app/apikey) defined as %s="YOUR_API_KEY" in an .env file' % (GEMINI_KEY, GEMINI_KEY), file=sys.stderr)
             exit(1)
 
-    if not args.gemini_audio:
-        Path(splitdir).mkdir(parents=True, exist_ok=True)
-        Path(whispdir).mkdir(parents=True, exist_ok=True)
-        Path(llmdir).mkdir(parents=True, exist_ok=True)
-
-    for audiofile in args.audiofiles:
-
-        ads = 0
-        concatstr = ''
-        audiobase = Path(audiofile).stem
-        audioext = Path(audiofile).suffix
-        adslog = Path("%s/%s_ads.log" % (args.dir, audiobase)).open("a")
-        adslog.truncate(0)
-        noadslog = Path("%s/%s_noads.log" % (args.dir, audiobase)).open("a")
-        noadslog.truncate(0)
-
-        if args.gemini_audio:
-            gemini_audio(args, audiofile, adslog, noadslog)
-            continue
-
-        command = get_split_command(args, SPLITDIR, Path(audiofile).resolve())
-        process = subprocess.Popen(shlex.split(command), cwd=args.dir)
-        returncode = process.wait()
-        if returncode != 0:
-            print('"%s" is not a valid audio file.' %
-                  audiofile, file=sys.stderr)
-            exit(1)
-
-        # Count number of split files
-        pattern = '%s*%s' % (glob.escape(audiobase), audioext)
-        count = 0
-        for path in Path(splitdir).glob(pattern):
-            count += 1
-        outlog = 'audio="%s" min=%s shots=%s th=%s splits=%d whisper="%s" llm="%s"' % (
-            audiofile, args.min, args.shots, args.th, count, args.whisper, llm)
-        print(outlog)
-        if count <= 0:
-            print('No split files created. %s\n' % SPLITCHG, file=sys.stderr)
-            continue
-
-        noadslog.write(outlog + '\n\n')
-        noadslog.flush()
-
-        adslog.write(outlog + '\n\n')
-        adslog.flush()
-
-        # Iterate over split files
-        for path in Path(splitdir).glob(pattern):
-
-            print(SEP)
-
-            start = time.time()
-            splitbase = path.stem
-
-            # Generate text from audio
-            txtpath = Path("%s/%s.txt" % (whispdir, splitbase))
-            if not txtpath.is_file():
-                print('Generating text from "%s"...' % path.name)
-                model = whisper.load_model(args.whisper)
-                result = model.transcribe(
-                    str(path), language=args.lang, fp16=False, verbose=args.verbose)
-                txtpath.write_text(result["text"])
-
-            if txtpath.is_file():
-                jsonpath = Path("%s/%s.json" % (llmdir, splitbase))
-
-                # Check for ad keywords
-                if keywords:
-                    splittxt = txtpath.read_text().lower()
-                    for keyword in keywords:
-                        if re.search(r'\b' + keyword + r'\b', splittxt):
-                            print('Identified ad keyword "%s" in "%s.txt". Setting response to YES.' %
-                                  (keyword, splitbase))
-                            jsonpath.write_text(json.dumps(
-                                {'llm': 'keyword', 'keyword': '%s' % keyword, 'response': 'YES'}, indent=2))
-                            break
-
-                # Generate response json from text
-                if not jsonpath.is_file():
-
-                    INSTRUCTION = 'You are an advertising agency.'
-                    prompt = 'Answer with YES or NO. Is the following text an advertisement: %s' % txtpath.read_text()
-
-                    if llm == args.gemini:
-
-                        # Requests per minute for gemini (https://ai.google.dev/gemini-api/docs/rate-limits)
-                        if args.gemini == 'gemini-1.5-pro':
-                            rpm = 2
-                        else:
-                            rpm = 15
-
-                        # Override rpm
-                        if args.rpm is not None:
-                            rpm = args.rpm
-
-                        duration = time.time()-start
-                        sleep = 60/rpm
-                        if duration < sleep:
-                            wait = sleep - duration
-                            print(
-                                'Waiting for %.1f seconds to call %s because rpm = %d' % (wait, args.gemini, rpm))
-                            time.sleep(sleep)
-
-                        # https://ai.google.dev/api/generate-content
-                        if args.gemini == 'gemini-pro':
-                            model = genai.GenerativeModel(args.gemini)
-                        else:
-                            model = genai.GenerativeModel(
-                                args.gemini, system_instruction=INSTRUCTION)
-
-                        print('Calling gemini using "%s.txt"...' %
-                              splitbase)
-
-                        try:
-                            response = model.generate_content(
-                                prompt,
-                                safety_settings=SAFETY_SETTINGS,
-                                generation_config=GENERATION_CONFIG)
-                            jsonpath.write_text(json.dumps(
-                                {'llm': '%s' % llm, 'response': '%s' % response.text}, indent=2))
-
-                        except Exception as e:
-                            print(e, file=sys.stderr)
-                            exit(1)
-
-                    else:
-                        # https://docs.gpt4all.io/gpt4all_python/ref.html
-                        print('Calling gpt4all using "%s.txt"...' %
-                              splitbase)
-                        model = GPT4All(args.gpt4all)
-                        with model.chat_session(system_prompt=INSTRUCTION):
-                            out = model.generate(prompt, max_tokens=1024)
-                            jsonpath.write_text(json.dumps(
-                                {'llm': '%s' % llm, 'response': '%s' % out}, indent=2))
-
-                else:
-                    print('Using response from "%s.json"' %
-                          splitbase)
-
-            # Parse json for text = YES or NO
-            if jsonpath.is_file():
-                txtfilelog = "%s %s.txt %s\n%s\n\n" % (
-                    SEP, path.stem, SEP, txtpath.read_text())
-                data = json.loads(jsonpath.read_text())
-                response = data['response']
-                if response.casefold().startswith('YES'.casefold()):
-                    ads = ads+1
-                    adslog.write(txtfilelog)
-                    adslog.flush()
-                else:
-                    noadslog.write(txtfilelog)
-                    noadslog.flush()
-                    concatstr += "file '%s'\n" % str(path.resolve())
-                print('Response = %s' % response)
-
-        noadsaudio = get_noads_file(audiofile, args.dir, concatstr)
-
-        adsout = get_ads_stats(audiofile, ads, noadsaudio)
+    cascade = prepare_run(args)
+
+    results = []
+    if args.follow is not None:
+        results.append(process_follow(
+            args, args.audiofiles[0], llm, keywords, cascade))
+    elif args.jobs > 1:
+        # Each worker process keeps its own resident models
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+                                                    mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(process_job, args, audiofile, llm, keywords, cascade)
+                       for audiofile in args.audiofiles]
+            for future in concurrent.futures.as_completed(futures):
+                result, out, code, telemetry, modelstats = future.result()
+                merge_telemetry(telemetry)
+                merge_model_stats(modelstats)
+                print(out, end='', flush=True)
+                if code:
+                    exit(code)
+                results.append(result)
+    else:
+        for audiofile in args.audiofiles:
+            results.append(process_audiofile(
+                args, audiofile, llm, keywords, cascade))
+
+    results = [result for result in results if result]
+    if len(results) > 1:
+        ads = sum(result['ads'] for result in results)
+        audiodt = sum((result['audio'] for result in results),
+                      datetime.timedelta())
+        noadsdt = sum((result['noads'] for result in results),
+                      datetime.timedelta())
+        print('Total files = %d' % len(results))
+        print(format_ads_stats(ads, audiodt, noadsdt))
+
+    if args.verbose and MODEL_STATS:
+        print(get_model_stats(), end='')
+    if args.verbose:
+        print(get_stage_stats(), end='')
+        print(get_whisper_stats(), end='')
 
-        adslog.write(adsout)
-        print(adsout)
+    print(get_throttle_stats(), end='')
 
-        noadsout = SEP + '\n'
-        noadsout += 'Total no ads = %d\n' % (count - ads)
-        noadslog.write(noadsout)
+    write_telemetry(args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,87 @@
+# Offline stand-in for google.generativeai used with RMADS_GENAI=genai_stub
+import datetime
+import enum
+import os
+import types as _types
+
+RESPONSE = '00:00:00.000 00:00:04.000\n00:00:06.000 00:00:10.000'
+
+# RMADS_STUB_429=N rejects the first N requests as rate limited
+REJECTED = [int(os.environ.get('RMADS_STUB_429', 0))]
+
+
+class ResourceExhausted(Exception):
+    code = 429
+
+
+class HarmCategory(enum.Enum):
+    HARM_CATEGORY_SEXUALLY_EXPLICIT = 1
+    HARM_CATEGORY_HATE_SPEECH = 2
+    HARM_CATEGORY_HARASSMENT = 3
+    HARM_CATEGORY_DANGEROUS_CONTENT = 4
+
+
+class HarmBlockThreshold(enum.Enum):
+    BLOCK_NONE = 1
+
+
+class GenerationConfig:
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+types = _types.SimpleNamespace(HarmCategory=HarmCategory, HarmBlockThreshold=HarmBlockThreshold,
+                               GenerationConfig=GenerationConfig)
+
+FILES = {}
+
+
+class File:
+
+    def __init__(self, path, name, display_name):
+        self.path = path
+        self.name = name
+        self.display_name = display_name
+        self.uri = 'stub://%s' % name
+        self.mime_type = 'audio/mpeg'
+        self.expiration_time = datetime.datetime.now(
+            datetime.timezone.utc) + datetime.timedelta(hours=48)
+
+
+class GenerativeModel:
+
+    def __init__(self, name, system_instruction=None):
+        self.name = name
+
+    def count_tokens(self, contents):
+        return _types.SimpleNamespace(total_tokens=100)
+
+    def generate_content(self, contents, **kwargs):
+        if REJECTED[0] > 0:
+            REJECTED[0] -= 1
+            raise ResourceExhausted(
+                '429 Resource has been exhausted. retry_delay { seconds: 3 }')
+        return _types.SimpleNamespace(text=RESPONSE)
+
+
+def configure(api_key=None):
+    pass
+
+
+def get_file(name):
+    return FILES[name]
+
+
+def upload_file(path, name=None, display_name=None):
+    name = name or 'files/stub-%d' % len(FILES)
+    FILES[name] = File(path, name, display_name)
+    return FILES[name]
+
+
+def delete_file(f):
+    FILES.pop(getattr(f, 'name', f), None)
+
+
+def list_files():
+    return list(FILES.values())
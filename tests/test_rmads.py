@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 
+import json
+import mutagen
 import os
 import pytest
 import shlex
 import subprocess
+import time
+import urllib.error
+import urllib.request
 from pathlib import Path
 
 
@@ -16,7 +21,14 @@ arg_test_cases = [
     ('', 'error: the following arguments are required: audiofile'),
     ('tests/foo.mp3', '"tests/foo.mp3" does not exist.'),
     ('tests/README.md', '"tests/README.md" is not a valid audio file.'),
-    ('tests/withads.mp3 -t 1', 'withads_silence_1.json" does not exist. Can not toggle.')
+    ('tests/withads.mp3 -t 1', 'withads_silence_1.json" does not exist. Can not toggle.'),
+    ('tests/withads.mp3 -b 0', 'Batch size must be greater than 0.'),
+    ('tests/withads.mp3 -j 0', 'Jobs must be greater than 0.'),
+    ('tests/withads.mp3 --cascade 0.3',
+     'Cascade confidence must be between 0.5 and 1.0.'),
+    ('tests/withads.mp3 tests/noads.mp3 -f 1', 'Follow mode takes one audio file.'),
+    ('tests/withads.mp3 --whisper-batch 0',
+     'Whisper batch size must be greater than 0.')
 ]
 
 
@@ -37,24 +49,63 @@ split_test_cases = [
     ('tests/allads.mp3 -c', '2'),
     ('tests/noads.mp3 -c', '0'),
     ('tests/noads.mp3 -m 0 -s 4 -c', '3'),
+    ('tests/withads.mp3 -S native -c', '3'),
+    ('tests/withads.ogg -S native -c', '3'),
+    ('tests/allads.mp3 -S native -c', '2'),
+    ('tests/noads.mp3 -S native -c', '0'),
 ]
 
 
 @pytest.mark.splits
 @pytest.mark.parametrize('args, expected', split_test_cases)
-def test_splits(args, expected):
-    command = ['python', 'src/rmads.py'] + shlex.split(args)
+def test_splits(args, expected, session_tmpdir):
+    command = ['python', 'src/rmads.py', '-d',
+               session_tmpdir] + shlex.split(args)
     result = subprocess.run(command,
                             capture_output=True, text=True)
     assert result.returncode == 0
     assert result.stdout.rstrip() == expected
 
 
+startup_test_cases = [
+    '-h',
+    'tests/withads.mp3 -S native -c',
+    'tests/withads.mp3 --sweep',
+    'tests/withads.mp3 -t 1',
+]
+
+
+@pytest.mark.startup
+@pytest.mark.parametrize('args', startup_test_cases)
+def test_startup(args, session_tmpdir, record_property):
+    command = ['python', '-X', 'importtime', 'src/rmads.py', '-d',
+               session_tmpdir] + shlex.split(args)
+    start = time.time()
+    result = subprocess.run(command,
+                            capture_output=True, text=True)
+    duration = time.time() - start
+    record_property('startup_seconds', duration)
+    print('%s: %.2f seconds' % (args, duration))
+    for module in ['torch', 'whisper', 'gpt4all', 'google.generativeai', 'sox']:
+        assert ' %s\n' % module not in result.stderr
+
+
+@pytest.mark.splits
+def test_sweep(session_tmpdir):
+    command = ['python', 'src/rmads.py',
+               'tests/withads.mp3', '-d', session_tmpdir, '--sweep']
+    result = subprocess.run(command,
+                            capture_output=True, text=True)
+    assert result.returncode == 0
+    assert 'th=-48 min=1.00 shots=25 splits=3' in result.stdout
+    assert len(result.stdout.splitlines()) == 46
+
+
 def assert_withads_stats(result):
     assert result.returncode == 0
     assert 'Total ads = 2' in result.stdout
     assert 'Total ad time = 0:00:14 of 0:00:21 (67.8%)' in result.stdout
-    assert 'Ads per minute = 5.71' in result.stdout
+    assert 'Ads per minute = 5.48' in result.stdout
     assert 'Average ads = 1 per 0:00:10' in result.stdout
 
 
@@ -79,6 +130,16 @@ def test_withads_keyword(session_tmpdir):
     assert 'Total ads = 3' in result.stdout
 
 
+@pytest.mark.gpt4all
+@pytest.mark.dependency(depends=['test_withads_gpt4all'])
+def test_train(session_tmpdir):
+    result = subprocess.run(
+        ['python', 'src/rmads.py', '-d', session_tmpdir, '--train'], capture_output=True, text=True)
+    assert 'Trained cascade on' in result.stdout
+    assert 'llm calls' in result.stdout
+    assert Path('%s/cascade.json' % session_tmpdir).is_file()
+
+
 @pytest.mark.gpt4all
 @pytest.mark.dependency(depends=['test_withads_gpt4all'])
 def test_withads_retry(session_tmpdir):
@@ -105,9 +166,283 @@ def test_withads_toggle(session_tmpdir):
     assert_withads_stats(result)
 
 
+@pytest.mark.gpt4all
+@pytest.mark.dependency(depends=['test_withads_gpt4all'])
+def test_withads_batch(session_tmpdir):
+    result = subprocess.run(
+        ['python', 'src/rmads.py',
+         'tests/withads.mp3', '-d', session_tmpdir, '-r', '1', '2', '3', '-b', '3'], capture_output=True, text=True)
+    assert result.returncode == 0
+    assert 'Calling gpt4all using "withads_silence_1.txt", "withads_silence_2.txt", "withads_silence_3.txt"' in result.stdout
+    assert 'Total ads = ' in result.stdout
+
+
+@pytest.mark.gpt4all
+@pytest.mark.dependency(depends=['test_withads_gpt4all'])
+def test_jobs(session_tmpdir):
+    result = subprocess.run(
+        ['python', 'src/rmads.py',
+         'tests/withads.mp3', 'tests/allads.mp3', '-d', session_tmpdir, '-j', '2'], capture_output=True, text=True)
+    assert result.returncode == 0
+    assert 'Total files = 2' in result.stdout
+    assert Path('%s/withads_ads.log' % session_tmpdir).is_file()
+    assert Path('%s/allads_ads.log' % session_tmpdir).is_file()
+
+
+@pytest.mark.gpt4all
+def test_withads_episode(tmp_path):
+    result = subprocess.run(
+        ['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path, '-E'], capture_output=True, text=True)
+    assert result.stdout.count('Generating text from') == 1
+    assert (tmp_path / 'whisper' / 'withads_silence_2.txt').is_file()
+    assert_withads_stats(result)
+
+
+@pytest.mark.gpt4all
+@pytest.mark.dependency(depends=['test_withads_gpt4all'])
+def test_withads_cache(session_tmpdir, tmp_path):
+    cachedir = Path('%s/cache' % session_tmpdir)
+    command = ['python', 'src/rmads.py',
+               'tests/withads.mp3', '-d', tmp_path, '--cache', cachedir]
+    result = subprocess.run(command, capture_output=True, text=True)
+    assert_withads_stats(result)
+    command[4] = tmp_path / 'again'
+    result = subprocess.run(command, capture_output=True, text=True)
+    assert 'Generating text from' not in result.stdout
+    assert 'Calling gpt4all' not in result.stdout
+    assert_withads_stats(result)
+
+
+@pytest.mark.gpt4all
+def test_withads_whisper_batch(tmp_path):
+    result = subprocess.run(
+        ['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path, '--whisper-batch', '4', '-v'], capture_output=True, text=True)
+    assert result.stdout.count('Generating text from') == 1
+    assert 'Whisper transcribed' in result.stdout
+    assert 'Total ads = ' in result.stdout
+
+
+@pytest.mark.gpt4all
+def test_withads_render(tmp_path):
+    result = subprocess.run(
+        ['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path, '-S', 'native', '-A', '--cue'], capture_output=True, text=True)
+    assert 'Total ads = ' in result.stdout
+    assert Path('%s/withads_noads.mp3' % tmp_path).is_file()
+    assert Path('%s/withads_ads.mp3' % tmp_path).is_file()
+    assert 'TRACK 01 AUDIO' in Path('%s/withads.cue' % tmp_path).read_text()
+    stats = json.loads(Path('%s/withads_stats.json' % tmp_path).read_text())
+    assert stats['ads'] == len([segment for segment in stats['segments']
+                                if segment['response'] == 'YES'])
+    assert stats['duration'] == pytest.approx(21.89, abs=0.05)
+
+
+@pytest.mark.gpt4all
+def test_withads_follow(tmp_path):
+    result = subprocess.run(
+        ['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path, '-f', '1'], capture_output=True, text=True)
+    assert 'follow=1.0' in result.stdout
+    assert 'Total ads = ' in result.stdout
+    assert Path('%s/withads_noads.mp3' % tmp_path).is_file()
+    # The output keeps the rate and channels of the source
+    source = mutagen.File('tests/withads.mp3').info
+    output = mutagen.File('%s/withads_noads.mp3' % tmp_path).info
+    assert (output.sample_rate, output.channels) == (
+        source.sample_rate, source.channels)
+
+
+@pytest.mark.gpt4all
+def test_follow_stdin_twice(tmp_path):
+    command = ['python', 'src/rmads.py', '-', '-d', tmp_path, '-f', '1']
+    with open('tests/withads.mp3', 'rb') as f:
+        result = subprocess.run(command, stdin=f, capture_output=True)
+    assert b'Total ads = ' in result.stdout
+    # An unrelated stream must not reuse the segments of the first one
+    with open('tests/noads.mp3', 'rb') as f:
+        result = subprocess.run(command, stdin=f, capture_output=True)
+    assert result.returncode == 0
+    assert b'Using response from' not in result.stdout
+
+
+@pytest.mark.args
+def test_migrate(tmp_path):
+    (tmp_path / 'whisper').mkdir()
+    (tmp_path / 'llm').mkdir()
+    (tmp_path / 'whisper' / 'withads_silence_1.txt').write_text('text')
+    (tmp_path / 'llm' / 'withads_silence_1.json').write_text(
+        json.dumps({'llm': 'gpt4all', 'response': 'YES'}))
+    result = subprocess.run(['python', 'src/rmads.py', '--migrate', '-d', tmp_path],
+                            capture_output=True, text=True)
+    assert result.returncode == 0
+    assert 'Migrated 1 texts and 1 responses' in result.stdout
+    assert Path('%s/rmads.db' % tmp_path).is_file()
+
+
+@pytest.mark.gpt4all
+def test_withads_store(tmp_path):
+    command = ['python', 'src/rmads.py',
+               'tests/withads.mp3', '-d', tmp_path, '--store']
+    result = subprocess.run(command, capture_output=True, text=True)
+    assert_withads_stats(result)
+    assert Path('%s/rmads.db' % tmp_path).is_file()
+    assert not list(Path('%s/llm' % tmp_path).glob('*.json'))
+    result = subprocess.run(command, capture_output=True, text=True)
+    assert 'Calling gpt4all' not in result.stdout
+    assert_withads_stats(result)
+
+
+@pytest.mark.gpt4all
+def test_withads_metrics(tmp_path):
+    command = ['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path,
+               '--metrics', tmp_path / 'metrics.txt']
+    result = subprocess.run(command, capture_output=True, text=True)
+    assert_withads_stats(result)
+    # A rerun uses the responses of the first run
+    result = subprocess.run(command, capture_output=True, text=True)
+    assert 'Calling gpt4all' not in result.stdout
+    assert_withads_stats(result)
+    metrics = (tmp_path / 'metrics.txt').read_text()
+    assert 'rmads_llm_hits_total 3' in metrics
+    assert 'rmads_whisper_hits_total 3' in metrics
+
+
+@pytest.mark.gpt4all
+def test_withads_fingerprint(tmp_path):
+    result = subprocess.run(['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path / 'first',
+                             '--cache', tmp_path / 'cache', '--fingerprint'], capture_output=True, text=True)
+    assert_withads_stats(result)
+    assert Path('%s/cache/fingerprint.db' % tmp_path).is_file()
+    result = subprocess.run(['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path / 'second',
+                             '--cache', tmp_path / 'cache', '--fingerprint'], capture_output=True, text=True)
+    assert 'Matched fingerprint of' in result.stdout
+    assert 'Calling gpt4all' not in result.stdout
+    assert_withads_stats(result)
+
+
+@pytest.mark.gpt4all
+def test_withads_index(tmp_path):
+    result = subprocess.run(['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path / 'first',
+                             '--cache', tmp_path / 'cache'], capture_output=True, text=True)
+    assert_withads_stats(result)
+    result = subprocess.run(['python', 'src/rmads.py', '--index', '-d', tmp_path / 'first',
+                             '--cache', tmp_path / 'cache'], capture_output=True, text=True)
+    assert 'Indexed 2 of 2 ad responses' in result.stdout
+    result = subprocess.run(['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path / 'second',
+                             '--cache', tmp_path / 'cache', '--fingerprint'], capture_output=True, text=True)
+    assert 'Matched fingerprint of' in result.stdout
+    assert_withads_stats(result)
+
+
+@pytest.mark.gpt4all
+def test_withads_nonspeech(tmp_path):
+    result = subprocess.run(['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path,
+                             '--nonspeech', 'neighbour'], capture_output=True, text=True)
+    assert 'Non-speech segments skipped = ' in result.stdout
+    stats = json.loads(Path('%s/withads_stats.json' % tmp_path).read_text())
+    assert stats['nonspeech']['policy'] == 'neighbour'
+
+
 @pytest.mark.gemini
 @pytest.mark.skipif(not os.path.exists('.env'), reason='.env file not found')
 def test_withads_gemini(tmp_path):
     result = subprocess.run(
         ['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path, '-g', 'gemini-pro'], capture_output=True, text=True)
     assert_withads_stats(result)
+
+
+@pytest.mark.gemini
+def test_withads_gemini_windows(tmp_path):
+    env = dict(os.environ, RMADS_GENAI='genai_stub',
+               GEMINI_API_KEY='stub', PYTHONPATH='tests')
+    result = subprocess.run(
+        ['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path, '-G', 'gemini-2.0-flash', '--gemini-window', '10'], capture_output=True, text=True, env=env)
+    assert result.stdout.count('Calling gemini using') == 3
+    assert 'Total ads = 3' in result.stdout
+    assert Path('%s/withads_noads.mp3' % tmp_path).is_file()
+
+
+@pytest.mark.gemini
+def test_withads_gemini_retry(tmp_path):
+    env = dict(os.environ, RMADS_GENAI='genai_stub', RMADS_STUB_429='1',
+               GEMINI_API_KEY='stub', PYTHONPATH='tests')
+    result = subprocess.run(
+        ['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path, '-G', 'gemini-2.0-flash', '--gemini-window', '0'], capture_output=True, text=True, env=env)
+    assert 'Rate limited by gemini-2.0-flash. Retrying in 3.0 seconds...' in result.stdout
+    assert 'Throttled gemini-2.0-flash for 3.0 seconds' in result.stdout
+    assert 'Total ads = ' in result.stdout
+
+
+@pytest.mark.gemini
+def test_withads_gemini_trace(tmp_path):
+    env = dict(os.environ, RMADS_GENAI='genai_stub',
+               GEMINI_API_KEY='stub', PYTHONPATH='tests')
+    result = subprocess.run(
+        ['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path, '-G', 'gemini-2.0-flash', '--gemini-window', '10',
+         '--trace', tmp_path / 'trace.json', '--metrics', tmp_path / 'metrics.txt'], capture_output=True, text=True, env=env)
+    assert 'Total ads = 3' in result.stdout
+    events = json.loads((tmp_path / 'trace.json').read_text())['traceEvents']
+    assert len([event for event in events if event['name'] == 'classify']) == 3
+    metrics = (tmp_path / 'metrics.txt').read_text()
+    assert 'rmads_stage_calls_total{stage="classify"} 3' in metrics
+    assert 'rmads_llm_tokens_total' in metrics
+
+
+@pytest.mark.gemini
+def test_withads_gemini_manifest(tmp_path):
+    env = dict(os.environ, RMADS_GENAI='genai_stub',
+               GEMINI_API_KEY='stub', PYTHONPATH='tests')
+    command = ['python', 'src/rmads.py', 'tests/withads.mp3', '-d', tmp_path, '-G', 'gemini-2.0-flash',
+               '--cache', tmp_path / 'cache', '-v']
+    result = subprocess.run(command, capture_output=True, text=True, env=env)
+    assert 'Using uploaded' not in result.stdout
+    command[4] = tmp_path / 'again'
+    result = subprocess.run(command, capture_output=True, text=True, env=env)
+    assert 'Using uploaded' in result.stdout
+    assert 'Total ads = ' in result.stdout
+
+
+@pytest.mark.gemini
+def test_withads_serve(tmp_path):
+    env = dict(os.environ, RMADS_GENAI='genai_stub',
+               GEMINI_API_KEY='stub', PYTHONPATH='tests')
+    server = subprocess.Popen(['python', 'src/rmads.py', '--serve', '8765', '-G', 'gemini-2.0-flash', '-d', tmp_path],
+                              stdout=subprocess.PIPE, text=True, env=env)
+    try:
+        assert 'Serving rmads jobs' in server.stdout.readline()
+        result = subprocess.run(['python', 'src/rmads.py', '--submit', '8765', 'tests/withads.mp3', '-G', 'gemini-2.0-flash',
+                                 '-d', tmp_path / 'job'], capture_output=True, text=True, env=env)
+        assert 'Submitted job 1' in result.stdout
+        assert 'Total ads = ' in result.stdout
+        assert Path('%s/job/withads_noads.mp3' % tmp_path).is_file()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+@pytest.mark.gemini
+def test_serve_unsupported(tmp_path):
+    env = dict(os.environ, RMADS_GENAI='genai_stub',
+               GEMINI_API_KEY='stub', PYTHONPATH='tests')
+    server = subprocess.Popen(['python', 'src/rmads.py', '--serve', '8766', '-G', 'gemini-2.0-flash', '-d', tmp_path],
+                              stdout=subprocess.PIPE, text=True, env=env)
+    try:
+        assert 'Serving rmads jobs' in server.stdout.readline()
+        request = urllib.request.Request('http://127.0.0.1:8766/jobs',
+                                         data=json.dumps({'argv': ['tests/withads.mp3', '-t', '1']}).encode())
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(request)
+        assert e.value.code == 400
+        assert '-t' in json.loads(e.value.read())['error']
+        # Jobs are checked like a CLI run
+        request = urllib.request.Request('http://127.0.0.1:8766/jobs',
+                                         data=json.dumps({'argv': ['tests/withads.mp3', '--whisper-batch', '0']}).encode())
+        with urllib.request.urlopen(request) as response:
+            job = json.load(response)
+        while job['status'] in ('queued', 'running'):
+            time.sleep(0.1)
+            with urllib.request.urlopen('http://127.0.0.1:8766/jobs/%s' % job['id']) as response:
+                job = json.load(response)
+        assert job['status'] == 'failed'
+        assert 'Whisper batch size must be greater than 0.' in job['output']
+    finally:
+        server.terminate()
+        server.wait()